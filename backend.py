@@ -2,30 +2,197 @@
 
 import os
 import errno
+import copy
 import time
 import tarfile
 import shutil
 import re
+import threading
+import hashlib
+import tempfile
+import zipfile
+import struct
+import zlib
+import json
 
 from utils import *
+from manifest import Manifest, ManifestStore
+from catalog import Catalog
+from journal import Journal
 import configuration
+import compression
 
 
 # a helper class for actual backends
 class BaseBackend(object):
 
+    # whether a given user's documents must be saved in the same order
+    # as they are listed (as opposed to whenever they're downloaded)
+    ordered_saves = False
+
+    # whether this backend keeps manifests of what it saves, and can re-use
+    # the files saved during previous sessions (see _carry_over)
+    incremental = False
+
     def __init__(self, keep_dirs):
         self._root_dir = configuration.Configuration.get(
             'backend_root_dir', not_null=True
         )
         self._keep_dirs = keep_dirs
-        self._session_name = self._generate_session_name()
+        # what had been done during the session we're resuming, if any
+        self._resumed_state = None
+        resumed_session = configuration.Configuration.get(
+            'backend_resume_session'
+        )
+        if resumed_session:
+            self._session_name = resumed_session
+            self._resumed_state = self._load_resumed_state()
+        else:
+            self._session_name = self._generate_session_name()
+        # several users can be processed concurrently, sub classes
+        # must hold that lock when touching any shared state
+        self._lock = threading.RLock()
+        # maps logins to locks that must be held when writing to
+        # that user's files
+        self._user_locks = dict()
+        self._use_previous_sessions = self.incremental and \
+            configuration.Configuration.get('backend_incremental',
+                                            is_bool=True)
+        self._manifest_store = ManifestStore(self._root_dir,
+                                             self._session_name)
+        # maps logins to the manifest being built for that user
+        self._manifests = dict()
+        # maps logins to that user's manifest from a previous session
+        # (or None if there's none)
+        self._previous_manifests = dict()
+        self._catalog = _open_catalog(self._root_dir)
+        self._catalog.start_session(self._session_name)
+        # only the backends that can resume a session need a journal
+        self._journal = Journal(self._root_dir, self._session_name) \
+            if self.incremental else None
         Log.verbose(u'Current session: {}'.format(self._session_name))
 
-    # can be overriden for more elaborate backends
-    def need_to_fetch_contents(self, user, document):
+    def _load_resumed_state(self):
+        if not self.incremental or \
+                not Journal.exists(self._root_dir, self._session_name):
+            ex = Exception(u'Cannot resume session {}'
+                           .format(self._session_name))
+            ex.brive_explanation = u'Session {} cannot be resumed '.format(
+                self._session_name
+            ) + '(it doesn\'t exist, has been completed, or the backend ' \
+                'doesn\'t support resuming sessions)'
+            raise ex
+        Log.verbose(u'Resuming session {}'.format(self._session_name))
+        return Journal.load(self._root_dir, self._session_name)
+
+    # called before backing up that user, returns False if there's no need
+    # to, because they've already been backed up (when resuming a session)
+    def start_user(self, user):
+        if self._resumed_state is None:
+            return True
+        if user.login in self._resumed_state.users:
+            return False
+        # forget what's been recorded so far, and re-record only the
+        # documents that are still there
+        self._catalog.delete_user(self._session_name, user.login)
+        self._prepare_resumed_user(user.login)
+        manifest = self._get_manifest(user)
+        entries = self._resumed_state.documents.get(user.login, dict())
+        nb_kept = 0
+        for doc_id, entry in entries.iteritems():
+            if all(os.path.exists(os.path.join(self._root_dir, f['path']))
+                   for f in entry['files']):
+                manifest.add_entry(doc_id, entry)
+                self._catalog.add_document(self._session_name, user.login,
+                                           doc_id, entry)
+                nb_kept += 1
+        Log.verbose(u'{} of {}\'s docs already saved during the session '
+                    .format(nb_kept, user.login) + u'we\'re resuming')
         return True
 
+    # called when resuming a session, before re-starting that user's
+    # backup: should get rid of whatever files can't be re-used as they are
+    def _prepare_resumed_user(self, login):
+        pass
+
+    # returns False if there's no need to fetch that document's contents,
+    # because its files from a previous session are still up-to-date
+    # and have been copied to the current session (or because they've
+    # already been saved during the session we're resuming)
+    def need_to_fetch_contents(self, user, document):
+        if self._resumed_state is not None:
+            entry = self._get_manifest(user).get(document.id)
+            if entry is not None and Manifest.is_up_to_date(entry, document):
+                Log.verbose(u'Doc id {} already saved, skipping it'
+                            .format(document.id))
+                return False
+        if not self._use_previous_sessions:
+            return True
+        entry = self._get_previous_entry(user, document)
+        if entry is None or not Manifest.is_up_to_date(entry, document):
+            return True
+        try:
+            files = self._carry_over(user, document, entry['files'])
+        except Exception as ex:
+            Log.verbose(u'Could not re-use the previous backup of doc id {}'
+                        .format(document.id) + u', fetching it: {}'.format(ex))
+            return True
+        self._record(user, document, files)
+        Log.verbose(u'Doc id {} hasn\'t changed, '.format(document.id) +
+                    're-using its previous backup')
+        return False
+
+    # should copy the files saved for that document during a previous
+    # session to the current one, and return the list of the new files
+    # (see Manifest.add for the format)
+    def _carry_over(self, user, document, files):
+        raise NotImplementedError()
+
+    # sub classes should call that for every document they save
+    def _record(self, user, document, files):
+        entry = Manifest.make_entry(document, files)
+        self._catalog.add_document(self._session_name, user.login,
+                                   document.id, entry)
+        if not self.incremental:
+            return
+        self._get_manifest(user).add_entry(document.id, entry)
+        self._journal.add_document(user.login, document.id, entry)
+
+    def _get_manifest(self, user):
+        with self._lock:
+            return self._manifests.setdefault(user.login, Manifest())
+
+    def _get_previous_entry(self, user, document):
+        manifest = self.get_previous_manifest(user)
+        return manifest.get(document.id) if manifest else None
+
+    # returns that user's manifest from the most recent previous session,
+    # or None if there's none
+    def get_previous_manifest(self, user):
+        if not self._use_previous_sessions:
+            return None
+        with self._lock:
+            if user.login not in self._previous_manifests:
+                self._previous_manifests[user.login] = \
+                    self._manifest_store.load_previous(user.login)
+            return self._previous_manifests[user.login]
+
+    # remembers the id of the most recent change in that user's Drive
+    # as of the start of their backup
+    def set_largest_change_id(self, user, change_id):
+        self._get_manifest(user).largest_change_id = change_id
+
+    def _get_user_lock(self, user):
+        with self._lock:
+            return self._user_locks.setdefault(user.login, threading.RLock())
+
+    # forgets everything about that user
+    def _forget_user(self, user):
+        with self._lock:
+            self._user_locks.pop(user.login, None)
+            self._previous_manifests.pop(user.login, None)
+            return self._manifests.pop(user.login, Manifest())
+
     # equivalent to *nix's _mkdir -p
     def _mkdir(self, path=''):
         try:
@@ -34,6 +201,38 @@ class BaseBackend(object):
             if ex.errno != errno.EEXIST:
                 raise
 
+    # hard links src to dest, or copies it if the file system doesn't allow
+    # hard links (or if link is False)
+    @staticmethod
+    def _link_or_copy(src, dest, link=True):
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if link:
+            try:
+                os.link(src, dest)
+                return
+            except OSError as ex:
+                if ex.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                    raise
+        shutil.copy2(src, dest)
+
+    # returns how much disk space deleting that path would free, i.e. the
+    # size of the files that aren't hard linked from anywhere else
+    def _get_freeable_size(self, name):
+        path = os.path.join(self._root_dir, name)
+        if os.path.isfile(path):
+            paths = [path]
+        else:
+            paths = [os.path.join(dir_path, file_name)
+                     for dir_path, _, file_names in os.walk(path)
+                     for file_name in file_names]
+        result = 0
+        for file_path in paths:
+            stat = os.lstat(file_path)
+            if stat.st_nlink == 1:
+                result += stat.st_size
+        return result
+
     # equivalent to *nix's rm -rf
     def _delete(self, name):
         path = os.path.join(self._root_dir, name)
@@ -44,10 +243,35 @@ class BaseBackend(object):
 
     def finalize(self):
         Log.verbose(u'Finalazing session: {}'.format(self._session_name))
+        # users that haven't been closed (e.g. when using --docs)
+        for login in self._catalog.get_pending_logins(self._session_name):
+            self._catalog.add_user(self._session_name, login,
+                                   self._get_user_paths(login))
+        self._catalog.finalize_session(self._session_name)
+        # nothing left to resume
+        if self.incremental:
+            self._journal.delete()
+
+    # called when stopping halfway through the session, should leave it in
+    # a state it can be resumed from (see --resume)
+    def suspend(self):
+        self._catalog.close()
+        if not self.incremental:
+            return
+        self._journal.close()
+        print u'### Session {} has been kept, resume it with --resume {} ###' \
+            .format(self._session_name, self._session_name)
 
     # called when this user is done
     def close_user(self, user):
-        pass
+        manifest = self._forget_user(user)
+        if self.incremental:
+            # that user has been successfully backed up
+            self._manifest_store.save(user.login, manifest)
+        self._catalog.add_user(self._session_name, user.login,
+                               self._get_user_paths(user.login))
+        if self.incremental:
+            self._journal.add_user(user.login)
 
     # called to save that doc for that user
     def save(self, user, document):
@@ -57,10 +281,23 @@ class BaseBackend(object):
     def clean_up(self):
         pass
 
+    # called if there was an exception while processing that user,
+    # should get rid of whatever has been saved for them so far
+    # without disturbing the other users
+    def discard_user(self, user):
+        self._forget_user(user)
+        self._catalog.delete_user(self._session_name, user.login)
+
     # should return the backup dir of file name for that login
     def _get_backup_name_for_user(self, login):
         return login
 
+    # should return all the paths (relative to the root dir) that make up
+    # that user's backup for the current session
+    def _get_user_paths(self, login):
+        return [os.path.join(self._session_name,
+                             self._get_backup_name_for_user(login))]
+
     # should return the login from a backup dir or file name
     # reverse of _get_backup_name_for_user
     def _get_login_from_name(self, name):
@@ -89,29 +326,114 @@ class DummyBackend(BaseBackend):
 # simplest backend possible: just download everything
 class SimpleBackend(BaseBackend):
 
+    incremental = True
+
     def __init__(self, keep_dirs):
         super(SimpleBackend, self).__init__(keep_dirs)
         self._mkdir(self._session_name)
         self._current_dir = os.path.join(self._root_dir, self._session_name)
+        # whether to hard link unchanged files from previous sessions
+        # instead of copying them
+        self._hardlink = configuration.Configuration.get('backend_hardlink',
+                                                         is_bool=True)
+        # set once suspended: archives can't be (re-)opened after that, it
+        # would truncate parts the journal already trusts
+        self._suspended = False
         Log.debug('SimpleBackend loaded')
 
     def save(self, user, document):
         path = self._get_path(user, document)
         self._mkdir(os.path.join(self._session_name, path))
-        prefix = os.path.join(self._current_dir, path)
+        files = []
         for document_content in document.contents:
-            path = os.path.join(prefix, document_content.file_name)
+            name = document_content.file_name
+            relative_path = os.path.join(self._session_name, path, name)
+            full_path = os.path.join(self._root_dir, relative_path)
             Log.debug(u'Writing {}\'s {} to {}'.format(
-                user.login, document.title, path
+                user.login, document.title, full_path
             ))
-            f = open(path, 'w')
+            # that file might be hard linked from a previous session, in
+            # which case we must not write into it
+            if os.path.lexists(full_path):
+                os.remove(full_path)
+            f = open(full_path, 'w')
             document_content.write_to_file(f)
             f.close()
+            files.append({'name': name, 'path': relative_path,
+                          'size': os.path.getsize(full_path)})
+        self._record(user, document, files)
+
+    def _carry_over(self, user, document, files):
+        path = self._get_path(user, document)
+        self._mkdir(os.path.join(self._session_name, path))
+        result = []
+        for previous_file in files:
+            name = previous_file['name']
+            previous_path = os.path.join(self._root_dir, previous_file['path'])
+            size = os.path.getsize(previous_path)
+            if 'size' in previous_file and size != previous_file['size']:
+                raise Exception(u'{} has been altered'.format(previous_path))
+            relative_path = os.path.join(self._session_name, path, name)
+            Log.debug(u'{} {} to {}'.format(
+                'Linking' if self._hardlink else 'Copying',
+                previous_file['path'], relative_path
+            ))
+            self._link_or_copy(previous_path,
+                               os.path.join(self._root_dir, relative_path),
+                               self._hardlink)
+            result.append({'name': name, 'path': relative_path,
+                           'size': size})
+        return result
+
+    # when suspending, the workers might still be saving documents: calls
+    # close_function with the login of each of those users that nobody is
+    # writing for at the moment, while holding their lock
+    # the others' archives aren't journaled, and will be deleted as
+    # unfinished when resuming
+    def _close_idle_users(self, logins, close_function):
+        with self._lock:
+            self._suspended = True
+        for login in logins:
+            with self._lock:
+                user_lock = self._user_locks.setdefault(login,
+                                                        threading.RLock())
+            if not user_lock.acquire(False):
+                Log.verbose(u'Still saving {}\'s documents, their current '
+                            .format(login) + 'archive won\'t be kept')
+                continue
+            try:
+                close_function(login)
+            finally:
+                user_lock.release()
+
+    def _check_not_suspended(self):
+        if self._suspended:
+            raise Exception(u'Session {} has been suspended'
+                            .format(self._session_name))
 
     def clean_up(self):
         Log.verbose(u'Unexpected shutdown, deleting {} folder'
                     .format(self._current_dir))
-        self._delete(self._session_name)
+        with self._lock:
+            self._delete(self._session_name)
+            # the manifests of the users already closed point to the files
+            # we've just deleted
+            self._manifest_store.delete(self._session_name)
+        self._catalog.delete_session(self._session_name)
+        self._journal.delete()
+
+    def discard_user(self, user):
+        if self._suspended:
+            # keep the parts that have been journaled, the others will be
+            # deleted when resuming
+            return
+        paths = self._get_user_paths(user.login)
+        Log.verbose(u'Discarding {}\'s partial backup {}'
+                    .format(user.login, ', '.join(paths)))
+        with self._lock:
+            for path in paths:
+                self._delete(path)
+        super(SimpleBackend, self).discard_user(user)
 
     def _get_path(self, user, document):
         path = os.path.join(
@@ -145,16 +467,32 @@ class SimpleBackend(BaseBackend):
     def _delete_old_saves_in_session(self, session_name, logins):
         current_bckup = os.path.join(self._root_dir, session_name)
         Log.debug(u'Processing old session {}'.format(current_bckup))
-        for name in os.listdir(current_bckup):
-            login = self._get_login_from_name(name)
-            if login and login in logins:
-                path_to_del = os.path.join(session_name, name)
-                Log.verbose(u'Deleting obsolete path {}'.format(path_to_del))
-                self._delete(path_to_del)
+        if self._catalog.has_session(session_name):
+            paths = [(login, path) for login in logins
+                     for path in self._catalog.get_user_paths(session_name,
+                                                              login)]
+        else:
+            # that session predates the catalog
+            paths = [(self._get_login_from_name(name),
+                      os.path.join(session_name, name))
+                     for name in os.listdir(current_bckup)]
+            paths = [(login, path) for login, path in paths
+                     if login and login in logins]
+        for login, path_to_del in paths:
+            # files hard linked from more recent sessions won't go away
+            if Log.is_verbose:
+                Log.verbose(u'Deleting obsolete path {} (frees {} bytes)'
+                            .format(path_to_del,
+                                    self._get_freeable_size(path_to_del)))
+            self._delete(path_to_del)
+            self._manifest_store.delete(session_name, login)
+            self._catalog.delete_user(session_name, login)
         # delete the whole dir if there's nothing left
         try:
             os.rmdir(current_bckup)
             Log.verbose(u'Deleting empty backup dir {}'.format(current_bckup))
+            self._manifest_store.delete(session_name)
+            self._catalog.delete_session(session_name)
         except OSError as ex:
             # ignore it if it's just not empty
             if ex.errno != errno.ENOTEMPTY:
@@ -176,79 +514,972 @@ class SimpleBackend(BaseBackend):
     def delete_old_saves(self, days):
         Log.debug('About to delete old backups...')
         self._do_delete_old_saves(
-            [self._get_login_from_name(name)
-                for name in os.listdir(self._current_dir)],
-            days
+            self._catalog.get_logins(self._session_name), days
         )
 
 
 # also downloads everything, but compresses it
 class TarBackend(SimpleBackend):
 
+    # keeps the archives' layout deterministic
+    ordered_saves = True
+
     def __init__(self, keep_dirs):
         super(TarBackend, self).__init__(keep_dirs)
         # get the compression format
         self._format = configuration.Configuration.get(
             'backend_compression_format', not_null=True
         )
-        if self._format not in ('gz', 'bz2'):
-            raise Exception(
-                'The compression format must be either gz or bz2, ' +
-                u'{} given'.format(format)
-            )
+        compression.check_format(self._format)
+        self._nb_compression_threads = configuration.Configuration.get(
+            'backend_compression_threads', is_int=True
+        )
+        # None means the format's default
+        self._compression_level = configuration.Configuration.get(
+            'backend_compression_level', is_int=True
+        )
+        # payloads that are already compressed go to a separate
+        # uncompressed archive, instead of being compressed again
+        self._compression_policy = _CompressionPolicy()
+        # maps (login, stored) tuples to the tar files being written
         self._tar_files = dict()
+        # maps logins to the number of the part being written (when resuming
+        # a session, new documents go to new archives, see _get_archive_name)
+        self._part_numbers = dict()
+        # maps logins to the paths of all the parts written for that user
+        self._archive_paths = dict()
+        # the archives we failed to write to, and that thus can't be
+        # re-used as they are when resuming
+        self._broken_paths = set()
+        # maps (login, path) tuples to archives from previous sessions
+        # we're currently copying from
+        self._previous_archives = dict()
         Log.debug('TarBackend loaded')
 
     # should return the backup dir of file name for that login
     def _get_backup_name_for_user(self, login):
-        return login + '.tar.' + self._format
+        return self._get_archive_name(login, False, 0)
+
+    # stored set to True gets the name of the uncompressed archive for
+    # payloads that are already compressed
+    # parts after the 1st one get a .partN suffix
+    def _get_archive_name(self, login, stored, part_number):
+        name = login
+        if part_number:
+            name += u'.part{}'.format(part_number)
+        if stored:
+            return name + '.stored.tar'
+        return name + '.tar.' + compression.get_extension(self._format)
 
-    _login_from_name_regex = re.compile(r'^(.*)\.tar\.(gz|bz2)$')
+    # recognizes all the formats, not only the current one, since previous
+    # sessions might have used other ones
+    _login_from_name_regex = re.compile(
+        r'^(.*?)(?:\.part(\d+))?(?:\.stored\.tar|\.tar\.(?:{}))$'.format(
+            '|'.join(compression.get_extensions())
+        )
+    )
 
     # should return the login from a backup dir or file name
     # reverse of _get_backup_name_for_user
     def _get_login_from_name(self, name):
+        match = self._login_from_name_regex.match(name)
+        return match.group(1) if match else None
+
+    # stored set to True gets the uncompressed archive
+    def _get_tarfile(self, user, create_if_doesnt_exist=True, stored=False):
+        key = (user.login, stored)
+        with self._lock:
+            # create the tarfile if we don't have one for this user yet
+            if key not in self._tar_files:
+                if not create_if_doesnt_exist:
+                    return None
+                self._check_not_suspended()
+                path = self._get_archive_path(user.login, stored)
+                self._archive_paths.setdefault(user.login, set()).add(path)
+                name = os.path.join(self._root_dir, path)
+                if stored:
+                    self._tar_files[key] = tarfile.open(name, 'w')
+                else:
+                    self._tar_files[key] = \
+                        compression.open_tarfile_for_writing(
+                            name, self._format, self._nb_compression_threads,
+                            self._compression_level
+                        )
+            return self._tar_files[key]
+
+    # closes that user's tarfiles (or all of them if login is None), and
+    # records them as complete if journal is set to True
+    def _close_tarfiles(self, login=None, journal=True):
+        with self._lock:
+            keys = [key for key in self._tar_files.keys()
+                    if login is None or key[0] == login]
+            tar_files = [(key, self._tar_files.pop(key)) for key in keys]
+        for (tar_login, stored), tar_file in tar_files:
+            tar_file.close()
+            path = self._get_archive_path(tar_login, stored)
+            if journal and path not in self._broken_paths:
+                self._journal.add_part(tar_login, path)
+
+    # writes a member to that tar file with write_function, remembering the
+    # archive is broken if that fails halfway through
+    def _write_member(self, user, stored, write_function):
         try:
-            return self._login_from_name_regex.findall(name)[0][0]
-        except IndexError:
-            # no match
-            return None
+            return write_function(self._get_tarfile(user, stored=stored))
+        except BaseException:
+            with self._lock:
+                self._broken_paths.add(
+                    self._get_archive_path(user.login, stored)
+                )
+            raise
 
-    def _get_tarfile(self, user, create_if_doesnt_exist=True):
-        # create the tarfile if we don't have one for this user yet
-        if user.login not in self._tar_files:
-            if not create_if_doesnt_exist:
-                return None
-            name = os.path.join(
-                self._current_dir, self._get_backup_name_for_user(user.login)
-            )
-            self._tar_files[user.login] = tarfile.open(
-                name, 'w:' + self._format
-            )
-        return self._tar_files[user.login]
+    def _get_archive_path(self, login, stored=False):
+        return os.path.join(self._session_name, self._get_archive_name(
+            login, stored, self._part_numbers.get(login, 0)
+        ))
+
+    def _get_user_paths(self, login):
+        with self._lock:
+            return sorted(self._archive_paths.get(login, []))
+
+    # keeps the archives that have been properly closed, and starts a new
+    # part after them
+    def _prepare_resumed_user(self, login):
+        last_part_number = -1
+        session_dir = os.path.join(self._root_dir, self._session_name)
+        for name in os.listdir(session_dir):
+            match = self._login_from_name_regex.match(name)
+            if not match or match.group(1) != login:
+                continue
+            path = os.path.join(self._session_name, name)
+            if path in self._resumed_state.parts:
+                with self._lock:
+                    self._archive_paths.setdefault(login, set()).add(path)
+                last_part_number = max(last_part_number,
+                                       int(match.group(2) or 0))
+            else:
+                Log.verbose(u'Deleting unfinished archive {}'.format(path))
+                self._delete(path)
+        self._part_numbers[login] = last_part_number + 1
 
     def save(self, user, document):
-        tar_file = self._get_tarfile(user)
-        for document_content in document.contents:
-            path = self._get_path(user, document)
-            path = os.path.join(path, document_content.file_name)
-            Log.debug(u'Writing {}\'s {} to {}'.format(
-                user.login, document.title, path
-            ))
-            file_object = document_content.get_file_object(True)
-            tarnfo = tarfile.TarInfo(path)
-            tarnfo.size = document_content.size
-            tarnfo.mtime = document.modified_timestamp
-            tar_file.addfile(tarnfo, file_object)
-            file_object.close()
+        files = []
+        # carried over documents are written from another thread
+        with self._get_user_lock(user):
+            for document_content in document.contents:
+                name = document_content.file_name
+                stored = self._compression_policy.should_store(document, name)
+                path = os.path.join(self._get_path(user, document), name)
+                Log.debug(u'Writing {}\'s {} to {}'.format(
+                    user.login, document.title, path
+                ))
+                file_object = document_content.get_file_object(True)
+                tarnfo = tarfile.TarInfo(path)
+                tarnfo.size = document_content.size
+                tarnfo.mtime = document.modified_timestamp
+                self._write_member(
+                    user, stored,
+                    lambda tar_file: tar_file.addfile(tarnfo, file_object)
+                )
+                # tarfile stops reading after the announced size, make sure
+                # we didn't truncate anything
+                if file_object.read(1):
+                    raise Exception(u'{} is bigger than the expected {} '
+                                    .format(name, tarnfo.size) + 'bytes')
+                file_object.close()
+                files.append({'name': name, 'member': path,
+                              'path': self._get_archive_path(user.login,
+                                                             stored),
+                              'size': tarnfo.size})
+        self._record(user, document, files)
+
+    def _carry_over(self, user, document, files):
+        result = []
+        with self._get_user_lock(user):
+            for previous_file in files:
+                name = previous_file['name']
+                stored = self._compression_policy.should_store(document, name)
+                path = os.path.join(self._get_path(user, document), name)
+                previous_archive = self._get_previous_archive(
+                    user, previous_file['path']
+                )
+                size = self._write_member(
+                    user, stored,
+                    lambda tar_file: previous_archive.copy_member(
+                        previous_file['member'], tar_file, path
+                    )
+                )
+                result.append({'name': name, 'member': path,
+                               'path': self._get_archive_path(user.login,
+                                                              stored),
+                               'size': size})
+        return result
+
+    def _get_previous_archive(self, user, path):
+        key = (user.login, path)
+        with self._lock:
+            if key not in self._previous_archives:
+                self._previous_archives[key] = _PreviousArchive(
+                    os.path.join(self._root_dir, path)
+                )
+            return self._previous_archives[key]
+
+    def _close_previous_archives(self, login=None):
+        with self._lock:
+            keys = [key for key in self._previous_archives.keys()
+                    if login is None or key[0] == login]
+            previous_archives = [self._previous_archives.pop(key)
+                                 for key in keys]
+        for previous_archive in previous_archives:
+            previous_archive.close()
 
     def close_user(self, user):
-        tar_file = self._get_tarfile(user, False)
-        if tar_file:
-            tar_file.close()
+        self._close_previous_archives(user.login)
+        self._close_tarfiles(user.login)
+        super(TarBackend, self).close_user(user)
+
+    def discard_user(self, user):
+        self._close_previous_archives(user.login)
+        try:
+            self._close_tarfiles(user.login, journal=False)
+        except Exception:
+            # we're getting rid of them anyway
+            pass
+        super(TarBackend, self).discard_user(user)
+        with self._lock:
+            self._archive_paths.pop(user.login, None)
+            self._part_numbers.pop(user.login, None)
 
     def finalize(self):
-        super(TarBackend, self).finalize()
+        self._close_previous_archives()
         Log.debug('Closing tar files')
-        for tar_file in self._tar_files.values():
-            tar_file.close()
+        self._close_tarfiles()
+        super(TarBackend, self).finalize()
+
+    def suspend(self):
+        with self._lock:
+            logins = set(login for login, _ in self._tar_files.keys())
+            logins.update(login for login, _ in self._previous_archives)
+
+        def close_user_files(login):
+            self._close_previous_archives(login)
+            # that makes them usable as they are when resuming
+            self._close_tarfiles(login)
+
+        self._close_idle_users(logins, close_user_files)
+        super(TarBackend, self).suspend()
+
+
+# decides which files are worth compressing
+class _CompressionPolicy(object):
+
+    def __init__(self):
+        self._enabled = configuration.Configuration.get(
+            'backend_skip_compressed', is_bool=True
+        )
+        self._stored_mime_types = configuration.Configuration.get(
+            'backend_stored_mime_types'
+        ) or []
+        self._stored_extensions = set(
+            extension.lower() for extension in configuration.Configuration.get(
+                'backend_stored_extensions'
+            ) or []
+        )
+
+    # returns true iff that file is already compressed (judging by the
+    # document's mime type, or the file's extension for exports), in which
+    # case compressing it again would only waste CPU
+    def should_store(self, document, file_name):
+        if not self._enabled:
+            return False
+        mime_type = document.get_meta('mimeType') or ''
+        for stored_mime_type in self._stored_mime_types:
+            # a trailing slash matches the whole family (e.g. video/)
+            if mime_type == stored_mime_type or (
+                    stored_mime_type.endswith('/')
+                    and mime_type.startswith(stored_mime_type)):
+                return True
+        extension = os.path.splitext(file_name)[1][1:].lower()
+        return extension in self._stored_extensions
+
+
+# also compresses everything, but in one zip archive per user, with a
+# sidecar index mapping each doc id to its files' offsets in the archive,
+# so that any file can be restored without reading the whole archive
+# (see --restore)
+class ZipBackend(SimpleBackend):
+
+    # the earliest date zip files can hold, in local time like zipfile
+    # reads them
+    _MIN_TIMESTAMP = int(time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1)))
+
+    def __init__(self, keep_dirs):
+        super(ZipBackend, self).__init__(keep_dirs)
+        # payloads that are already compressed are stored as they are
+        self._compression_policy = _CompressionPolicy()
+        # maps logins to the zip files being written
+        self._zip_files = dict()
+        # maps logins to the indexes of those zip files
+        self._indexes = dict()
+        # maps logins to the number of the part being written (when resuming
+        # a session, new documents go to new archives, see _get_archive_name)
+        self._part_numbers = dict()
+        # maps logins to the paths of all the parts written for that user
+        self._archive_paths = dict()
+        # maps (login, path) tuples to the indexes of archives from previous
+        # sessions
+        self._previous_indexes = dict()
+        Log.debug('ZipBackend loaded')
+
+    # should return the backup dir of file name for that login
+    def _get_backup_name_for_user(self, login):
+        return self._get_archive_name(login, 0)
+
+    # parts after the 1st one get a .partN suffix
+    @staticmethod
+    def _get_archive_name(login, part_number):
+        if part_number:
+            return u'{}.part{}.zip'.format(login, part_number)
+        return login + '.zip'
+
+    # the archives, and their indexes
+    def _get_user_paths(self, login):
+        with self._lock:
+            archive_paths = sorted(self._archive_paths.get(login, []))
+        return [path for archive_path in archive_paths for path in
+                (archive_path, _ZipArchiveIndex.get_path(archive_path))]
+
+    _login_from_name_regex = re.compile(
+        r'^(.*?)(?:\.part(\d+))?\.(?:zip|index\.json)$'
+    )
+
+    # should return the login from a backup dir or file name
+    # reverse of _get_backup_name_for_user
+    def _get_login_from_name(self, name):
+        match = self._login_from_name_regex.match(name)
+        return match.group(1) if match else None
+
+    def _get_archive_path(self, login):
+        return os.path.join(self._session_name, self._get_archive_name(
+            login, self._part_numbers.get(login, 0)
+        ))
+
+    # keeps the archives that have been properly closed (and their indexes),
+    # and starts a new part after them
+    def _prepare_resumed_user(self, login):
+        last_part_number = -1
+        session_dir = os.path.join(self._root_dir, self._session_name)
+        for name in os.listdir(session_dir):
+            match = self._login_from_name_regex.match(name)
+            if not match or match.group(1) != login:
+                continue
+            path = os.path.join(self._session_name, name)
+            archive_path = _ZipArchiveIndex.get_archive_path(path)
+            if archive_path in self._resumed_state.parts:
+                with self._lock:
+                    self._archive_paths.setdefault(login, set()).add(
+                        archive_path
+                    )
+                last_part_number = max(last_part_number,
+                                       int(match.group(2) or 0))
+            else:
+                Log.verbose(u'Deleting unfinished archive {}'.format(path))
+                self._delete(path)
+        self._part_numbers[login] = last_part_number + 1
+
+    def _get_zipfile(self, user):
+        with self._lock:
+            # create the zip file if we don't have one for this user yet
+            if user.login not in self._zip_files:
+                self._check_not_suspended()
+                path = self._get_archive_path(user.login)
+                self._archive_paths.setdefault(user.login, set()).add(path)
+                self._zip_files[user.login] = zipfile.ZipFile(
+                    os.path.join(self._root_dir, path), 'w',
+                    zipfile.ZIP_DEFLATED, allowZip64=True
+                )
+                self._indexes[user.login] = _ZipArchiveIndex(
+                    os.path.join(self._root_dir, path)
+                )
+            return self._zip_files[user.login], self._indexes[user.login]
+
+    def save(self, user, document):
+        files = []
+        # carried over documents are written from another thread
+        with self._get_user_lock(user):
+            for document_content in document.contents:
+                name = document_content.file_name
+                Log.debug(u'Writing {}\'s {} to {}'.format(
+                    user.login, document.title,
+                    self._get_archive_path(user.login)
+                ))
+                # zipfile can only write files from the disk
+                temp_file = tempfile.NamedTemporaryFile()
+                try:
+                    document_content.write_to_file(temp_file)
+                    temp_file.flush()
+                    files.append(self._add_file(user, document, name,
+                                                temp_file.name))
+                finally:
+                    temp_file.close()
+        self._record(user, document, files)
+
+    # adds the file at that path to the user's archive
+    # returns the corresponding manifest entry
+    def _add_file(self, user, document, name, path):
+        zip_file, index = self._get_zipfile(user)
+        member = os.path.join(self._get_path(user, document), name)
+        # that's where zipfile gets the entry's date from, and zip files
+        # can't hold dates before 1980 (e.g. when we don't know the date)
+        timestamp = max(document.modified_timestamp, self._MIN_TIMESTAMP)
+        os.utime(path, (timestamp, timestamp))
+        compress_type = zipfile.ZIP_STORED \
+            if self._compression_policy.should_store(document, name) \
+            else zipfile.ZIP_DEFLATED
+        zip_file.write(path, member, compress_type)
+        zip_info = zip_file.filelist[-1]
+        index.add(document, name, zip_info)
+        return {'name': name, 'member': member,
+                'path': self._get_archive_path(user.login),
+                'size': zip_info.file_size}
+
+    def _carry_over(self, user, document, files):
+        result = []
+        with self._get_user_lock(user):
+            for previous_file in files:
+                name = previous_file['name']
+                previous_index = self._get_previous_index(
+                    user, previous_file['path']
+                )
+                file_entry = previous_index.get_file(document.id, name)
+                if file_entry is None:
+                    raise Exception(u'No {} in {}\'s index'.format(
+                        name, previous_file['path']
+                    ))
+                temp_file = tempfile.NamedTemporaryFile()
+                try:
+                    previous_index.extract(file_entry, temp_file)
+                    temp_file.flush()
+                    result.append(self._add_file(user, document, name,
+                                                 temp_file.name))
+                finally:
+                    temp_file.close()
+        return result
+
+    def _get_previous_index(self, user, path):
+        key = (user.login, path)
+        with self._lock:
+            if key not in self._previous_indexes:
+                self._previous_indexes[key] = _ZipArchiveIndex.load(
+                    os.path.join(self._root_dir, path)
+                )
+            return self._previous_indexes[key]
+
+    # removes that user's zip file from the open ones, closes it, and saves
+    # its index (unless save is False), recording it as complete
+    def _close_zipfile(self, login, save=True):
+        with self._lock:
+            zip_file = self._zip_files.pop(login, None)
+            index = self._indexes.pop(login, None)
+            for key in self._previous_indexes.keys():
+                if key[0] == login:
+                    del self._previous_indexes[key]
+        if not zip_file:
+            return
+        zip_file.close()
+        if save:
+            index.save()
+            self._journal.add_part(login, self._get_archive_path(login))
+
+    def _close_zipfiles(self):
+        with self._lock:
+            logins = self._zip_files.keys()
+        for login in logins:
+            self._close_zipfile(login)
+
+    def close_user(self, user):
+        self._close_zipfile(user.login)
+        super(ZipBackend, self).close_user(user)
+
+    def discard_user(self, user):
+        try:
+            self._close_zipfile(user.login, save=False)
+        except Exception:
+            # we're getting rid of it anyway
+            pass
+        super(ZipBackend, self).discard_user(user)
+        with self._lock:
+            self._archive_paths.pop(user.login, None)
+            self._part_numbers.pop(user.login, None)
+
+    def finalize(self):
+        Log.debug('Closing zip files')
+        self._close_zipfiles()
+        super(ZipBackend, self).finalize()
+
+    # zipfile only writes the entries it's done with to the central
+    # directory, so the archives can be closed and re-used as they are
+    def suspend(self):
+        with self._lock:
+            logins = self._zip_files.keys()
+        self._close_idle_users(logins, self._close_zipfile)
+        super(ZipBackend, self).suspend()
+
+
+# stores each version of each document only once, in a content-addressed
+# object store shared by all users and sessions, and hard links it into
+# the users' backups
+class DedupBackend(SimpleBackend):
+
+    def __init__(self, keep_dirs):
+        super(DedupBackend, self).__init__(keep_dirs)
+        self._store = _ObjectStore(os.path.join(self._root_dir, 'objects'))
+        # objects stored during the current session (only those can be
+        # re-used if we're not allowed to use previous sessions)
+        self._stored_keys = set()
+        # maps (login, doc id) tuples to the keys claimed for that document
+        self._claims = dict()
+        Log.debug('DedupBackend loaded')
+
+    def need_to_fetch_contents(self, user, document):
+        keys = self._get_keys(document)
+        if keys is None:
+            # can't tell which version it is
+            return True
+        missing_keys = [key for key in keys if not self._claim(user, key)]
+        if missing_keys:
+            # we're the ones fetching that document's missing objects,
+            # we'll release them once saved
+            with self._lock:
+                self._claims[(user.login, document.id)] = missing_keys
+            return True
+        self._record(user, document, self._link_objects(user, document,
+                                                       keys))
+        Log.verbose(u'Doc id {} already stored, linking it'
+                    .format(document.id))
+        return False
+
+    def save(self, user, document):
+        if self._get_keys(document) is None:
+            # can't tell which version it is
+            return super(DedupBackend, self).save(user, document)
+        # link the formats we actually got, which aren't always the ones
+        # we asked for (see Document._do_fetch_contents)
+        keys = []
+        try:
+            for document_content in document.contents:
+                key = self._get_key(document, document_content.format)
+                keys.append(key)
+                if self._is_stored(key):
+                    continue
+                Log.debug(u'Storing {}\'s {} as object {}'.format(
+                    user.login, document.title, key
+                ))
+                self._store.put(key, document_content)
+                with self._lock:
+                    self._stored_keys.add(key)
+        finally:
+            self._release_claims(user.login, document.id)
+        self._record(user, document, self._link_objects(user, document,
+                                                       keys))
+
+    def discard_user(self, user):
+        with self._lock:
+            doc_ids = [doc_id for login, doc_id in self._claims.keys()
+                       if login == user.login]
+        for doc_id in doc_ids:
+            self._release_claims(user.login, doc_id)
+        super(DedupBackend, self).discard_user(user)
+
+    def delete_old_saves(self, days):
+        super(DedupBackend, self).delete_old_saves(days)
+        self._store.collect_garbage()
+
+    # returns the keys of the objects for that document, one per format,
+    # or None if we can't identify that document's version
+    def _get_keys(self, document):
+        if not self._get_revision(document):
+            return None
+        return [self._get_key(document, fmt) for fmt in document.formats]
+
+    @staticmethod
+    def _get_revision(document):
+        return document.get_meta('md5Checksum') \
+            or document.get_meta('modifiedDate')
+
+    def _get_key(self, document, fmt):
+        key = u'{}\0{}\0{}'.format(document.id, self._get_revision(document),
+                                   fmt)
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    # returns True if that object is already stored (and can be used), False
+    # if it isn't, in which case it's now ours to fetch
+    def _claim(self, user, key):
+        return not self._store.claim(key, user.login,
+                                     lambda: self._is_stored(key))
+
+    def _is_stored(self, key):
+        if not self._use_previous_sessions:
+            with self._lock:
+                if key not in self._stored_keys:
+                    return False
+        return self._store.get(key) is not None
+
+    def _release_claims(self, login, doc_id):
+        with self._lock:
+            keys = self._claims.pop((login, doc_id), [])
+        for key in keys:
+            self._store.release(key, login)
+
+    def _link_objects(self, user, document, keys):
+        path = self._get_path(user, document)
+        self._mkdir(os.path.join(self._session_name, path))
+        files = []
+        for key in keys:
+            object_path = self._store.get(key)
+            if object_path is None:
+                continue
+            # the object's name is the file's name when it was first saved,
+            # but the document's title might differ for other users
+            extension = os.path.splitext(object_path)[1]
+            name = u'{}_{}{}'.format(document.title, document.id, extension)
+            relative_path = os.path.join(self._session_name, path, name)
+            self._link_or_copy(object_path,
+                               os.path.join(self._root_dir, relative_path))
+            files.append({'name': name, 'path': relative_path, 'key': key})
+        return files
+
+
+# opens the catalog of that root dir, creating the dir if needed
+def _open_catalog(root_dir):
+    try:
+        os.makedirs(root_dir)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    return Catalog(os.path.join(root_dir, configuration.Configuration.get(
+        'backend_catalog_file', not_null=True
+    )))
+
+
+# returns the backups of that doc found in the catalog, most recent first
+# (see Catalog.find_document)
+def find_document(doc_id):
+    root_dir = configuration.Configuration.get('backend_root_dir',
+                                               not_null=True)
+    return _open_catalog(root_dir).find_document(doc_id)
+
+
+# extracts the files of that doc from the most recent backup of that user
+# to dest_dir, whatever the backend that saved it, and returns their paths
+def restore_document(login, doc_id, dest_dir):
+    root_dir = configuration.Configuration.get('backend_root_dir',
+                                               not_null=True)
+    backups = _open_catalog(root_dir).find_document(doc_id, login)
+    if not backups:
+        ex = Exception(u'Doc {} of {} not found'.format(doc_id, login))
+        ex.brive_explanation = u'No backup of {}\'s doc id {} found ' \
+            .format(login, doc_id) + u'in {}'.format(root_dir)
+        raise ex
+    backup = backups[0]
+    Log.verbose(u'Restoring doc id {} from session {}'
+                .format(doc_id, backup['session']))
+    result = []
+    for file_entry in backup['files']:
+        path = os.path.join(dest_dir, file_entry['name'])
+        archive_path = os.path.join(root_dir, file_entry['path'])
+        with open(path, 'wb') as dest:
+            if file_entry['member'] is None:
+                with open(archive_path, 'rb') as source:
+                    shutil.copyfileobj(source, dest)
+            elif archive_path.endswith('.zip'):
+                # no need to read the whole archive
+                index = _ZipArchiveIndex.load(archive_path)
+                index.extract(index.get_file(doc_id, file_entry['name']),
+                              dest)
+            else:
+                archive = _PreviousArchive(archive_path)
+                try:
+                    archive.extract_member(file_entry['member'], dest)
+                finally:
+                    archive.close()
+        result.append(path)
+    return result
+
+
+# a content-addressed store of files: each object is a dir named after its
+# key, containing a single file
+# also makes sure that only one thread fetches a given object at a time
+class _ObjectStore(object):
+
+    # how long (in seconds) we wait for another thread to fetch an object
+    # before fetching it ourselves
+    _CLAIM_TIMEOUT = 600
+
+    def __init__(self, root_dir):
+        self._root_dir = root_dir
+        self._lock = threading.Lock()
+        # maps the keys of the objects being fetched to a (owner, event)
+        # tuple, the event being set once the object is stored
+        self._claims = dict()
+
+    # returns the path to that object, or None if it's not stored
+    def get(self, key):
+        object_dir = self._get_dir(key)
+        try:
+            names = os.listdir(object_dir)
+        except OSError:
+            return None
+        # ignore temp files
+        names = [name for name in names if not name.startswith('.')]
+        return os.path.join(object_dir, names[0]) if names else None
+
+    # returns True if the object isn't stored (according to is_stored),
+    # in which case the owner is now responsible for storing it (and must
+    # then release it)
+    # if someone else is already fetching it, waits for them
+    def claim(self, key, owner, is_stored):
+        deadline = time.time() + self._CLAIM_TIMEOUT
+        while True:
+            if is_stored():
+                return False
+            with self._lock:
+                claim = self._claims.get(key)
+                if claim is None or claim[0] == owner \
+                        or time.time() > deadline:
+                    self._claims[key] = (owner, threading.Event())
+                    return True
+            Log.debug(u'Waiting for object {} to be fetched'.format(key))
+            claim[1].wait(1)
+
+    def release(self, key, owner):
+        with self._lock:
+            claim = self._claims.get(key)
+            if claim is not None and claim[0] == owner:
+                del self._claims[key]
+                claim[1].set()
+
+    def put(self, key, document_content):
+        object_dir = self._get_dir(key)
+        try:
+            os.makedirs(object_dir)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        # write to a temp file first, so that we never leave a half-written
+        # object behind
+        fd, tmp_path = tempfile.mkstemp(dir=object_dir, prefix='.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                document_content.write_to_file(f)
+            os.rename(tmp_path, os.path.join(object_dir,
+                                             document_content.file_name))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    # deletes the objects that no backup links to anymore
+    def collect_garbage(self):
+        Log.verbose(u'Deleting unused objects in {}'.format(self._root_dir))
+        if not os.path.isdir(self._root_dir):
+            return
+        nb_deleted = 0
+        for shard in os.listdir(self._root_dir):
+            shard_dir = os.path.join(self._root_dir, shard)
+            for key in os.listdir(shard_dir):
+                with self._lock:
+                    if key in self._claims:
+                        continue
+                object_path = self.get(key)
+                if object_path and os.stat(object_path).st_nlink > 1:
+                    continue
+                shutil.rmtree(os.path.join(shard_dir, key))
+                nb_deleted += 1
+        Log.verbose(u'Deleted {} unused objects'.format(nb_deleted))
+
+    def _get_dir(self, key):
+        return os.path.join(self._root_dir, key[:2], key)
+
+
+# reads an archive from a previous session, to copy some of its members to
+# the current session's archive
+# since compressed archives can only be read sequentially, the members are
+# first read in order; as soon as one is requested out of order, the archive
+# gets copied once and for all to a seekable uncompressed temp file, and
+# indexed
+class _PreviousArchive(object):
+
+    def __init__(self, path):
+        self._path = path
+        self._tar_file = None
+        # the uncompressed copy, and the members' TarInfos in it, by name
+        # (None as long as we can read the members in order)
+        self._copy = None
+        self._members = None
+
+    # copies the member with that name to dest_tar_file, under new_name
+    # returns its size
+    def copy_member(self, name, dest_tar_file, new_name):
+        member = self._find_member(name)
+        source = self._tar_file.extractfile(member)
+        # don't rename the indexed one
+        member = copy.copy(member)
+        member.name = new_name
+        dest_tar_file.addfile(member, source)
+        return member.size
+
+    # writes the contents of the member with that name to dest
+    def extract_member(self, name, dest):
+        member = self._find_member(name)
+        shutil.copyfileobj(self._tar_file.extractfile(member), dest)
+
+    def _find_member(self, name):
+        if self._members is None:
+            from_start = self._tar_file is None
+            if from_start:
+                Log.debug(u'Opening previous archive {}'.format(self._path))
+                self._tar_file = compression.open_tarfile_for_reading(
+                    self._path
+                )
+            member = self._tar_file.next()
+            while member is not None:
+                # no need to keep track of the members we've gone past,
+                # and we can't go back to them anyway
+                self._tar_file.members = []
+                if member.name == name:
+                    return member
+                member = self._tar_file.next()
+            self.close()
+            if from_start:
+                raise KeyError(u'No member {} in {}'.format(name, self._path))
+            # it's behind us: going through the archive again for each such
+            # member would be quadratic
+            self._index()
+        member = self._members.get(name)
+        if member is None:
+            raise KeyError(u'No member {} in {}'.format(name, self._path))
+        return member
+
+    def _index(self):
+        Log.debug(u'Indexing previous archive {}'.format(self._path))
+        self._copy = tempfile.TemporaryFile()
+        source = compression.open_tarfile_for_reading(self._path)
+        try:
+            tar_copy = tarfile.open(fileobj=self._copy, mode='w')
+            member = source.next()
+            while member is not None:
+                source.members = []
+                tar_copy.addfile(member, source.extractfile(member))
+                member = source.next()
+            tar_copy.close()
+        finally:
+            source.close()
+        self._copy.seek(0)
+        self._tar_file = tarfile.open(fileobj=self._copy, mode='r:')
+        self._members = {member.name: member
+                         for member in self._tar_file.getmembers()}
+
+    def close(self):
+        if self._tar_file is not None:
+            self._tar_file.close()
+            self._tar_file = None
+        if self._copy is not None:
+            self._copy.close()
+            self._copy = None
+            self._members = None
+
+
+# the sidecar index of a zip archive, mapping doc ids to their titles, and
+# their files' names, members and offsets in the archive
+class _ZipArchiveIndex(object):
+
+    _CHUNK_SIZE = 1048576  # 1 Mb
+
+    def __init__(self, archive_path, entries=None):
+        self._archive_path = archive_path
+        self._entries = entries if entries is not None else dict()
+
+    @staticmethod
+    def get_path(archive_path):
+        return re.sub(r'\.zip$', '.index.json', archive_path)
+
+    # reverse of get_path
+    @staticmethod
+    def get_archive_path(path):
+        return re.sub(r'\.index\.json$', '.zip', path)
+
+    def get(self, doc_id):
+        return self._entries.get(doc_id)
+
+    # returns the entry for that file of that doc, or None
+    def get_file(self, doc_id, name):
+        entry = self.get(doc_id)
+        if entry is None:
+            return None
+        for file_entry in entry['files']:
+            if file_entry['name'] == name:
+                return file_entry
+        return None
+
+    def add(self, document, name, zip_info):
+        entry = self._entries.setdefault(
+            document.id, {'title': document.title, 'files': []}
+        )
+        entry['files'].append({
+            'name': name,
+            'member': zip_info.filename,
+            'offset': zip_info.header_offset,
+            'size': zip_info.file_size,
+            'compressed_size': zip_info.compress_size,
+            'compress_type': zip_info.compress_type,
+            'crc': zip_info.CRC
+        })
+
+    def save(self):
+        path = self.get_path(self._archive_path)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as stream:
+            json.dump(self._entries, stream)
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(archive_path):
+        path = _ZipArchiveIndex.get_path(archive_path)
+        with open(path, 'r') as stream:
+            return _ZipArchiveIndex(archive_path, json.load(stream))
+
+    # writes the contents of that file to dest, reading only that file's
+    # data from the archive
+    def extract(self, file_entry, dest):
+        with open(self._archive_path, 'rb') as archive:
+            archive.seek(file_entry['offset'])
+            header = struct.unpack(zipfile.structFileHeader,
+                                   archive.read(zipfile.sizeFileHeader))
+            if header[0] != zipfile.stringFileHeader:
+                raise Exception(u'Bad zip header for {} in {}'.format(
+                    file_entry['member'], self._archive_path
+                ))
+            # skip the file name and the extra field
+            archive.seek(header[-2] + header[-1], os.SEEK_CUR)
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS) \
+                if file_entry['compress_type'] == zipfile.ZIP_DEFLATED \
+                else None
+            remaining = file_entry['compressed_size']
+            crc = 0
+            while remaining:
+                chunk = archive.read(min(remaining, self._CHUNK_SIZE))
+                if not chunk:
+                    raise Exception(u'{} is truncated'
+                                    .format(self._archive_path))
+                remaining -= len(chunk)
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                crc = zlib.crc32(chunk, crc)
+                dest.write(chunk)
+            if decompressor:
+                chunk = decompressor.flush()
+                crc = zlib.crc32(chunk, crc)
+                dest.write(chunk)
+        if crc & 0xffffffff != file_entry['crc']:
+            raise Exception(u'Bad CRC for {} in {}'.format(
+                file_entry['member'], self._archive_path
+            ))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# measures how long ServiceListEnumerator takes per item, with a fake
+# service serving a single page: half of it gets consumed, then the page is
+# fetched again (as after an error), and the rest of it is consumed
+# usage: python benchmarks/bench_enumerator.py [items per page...]
+
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir)
+sys.path.insert(0, ROOT_DIR)
+
+# client needs to be imported first, model and client import each other
+import client
+from configuration import Configuration
+from utils import Log
+
+
+class _FakeService(object):
+
+    def __init__(self, nb_items):
+        self._response = {
+            'items': [{'id': str(i)} for i in range(nb_items)]
+        }
+
+    def files(self):
+        return self
+
+    def list(self, **kwargs):
+        return self
+
+    def execute(self):
+        return self._response
+
+
+class _FakeEnumerator(client.ServiceListEnumerator):
+
+    _service_object_name = 'files'
+    _items_field = 'items'
+
+    def __init__(self, nb_items):
+        self._nb_items = nb_items
+
+    def _regenerate_service(self):
+        return _FakeService(self._nb_items)
+
+    def _list_kwargs(self):
+        return dict()
+
+    def _process_item(self, item):
+        return item['id']
+
+
+def run(nb_items):
+    enumerator = iter(_FakeEnumerator(nb_items))
+    start = time.time()
+    for _ in range(nb_items / 2):
+        enumerator.add_processed_id(enumerator.next())
+    enumerator.reset_to_current_page()
+    nb_consumed = nb_items / 2
+    # iterating again would start over
+    try:
+        while True:
+            enumerator.next()
+            nb_consumed += 1
+    except StopIteration:
+        pass
+    assert nb_consumed == nb_items
+    return (time.time() - start) / nb_items * 1e6
+
+
+def main():
+    Log.init(False, False)
+    Configuration(os.path.join(ROOT_DIR, 'settings.yml.tpl'),
+                  os.path.join(ROOT_DIR, 'constants.yml'))
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000, 30000]
+    print '{:>10}  {:>8}'.format('items/page', 'us/item')
+    for size in sizes:
+        print '{:>10}  {:>8.1f}'.format(size, run(size))
+
+
+if __name__ == '__main__':
+    main()
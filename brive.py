@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import os
 import logging
 logging.basicConfig(level=logging.ERROR)
 
 from configuration import *
 from client import Client
 from model import User
+from scheduler import UserScheduler
 
 
 def main():
@@ -39,9 +41,19 @@ def main():
                         'exaclty one user)')
     parser.add_argument('--keep-on-crash', dest='keep_on_crash',
                         action='store_const', const=True, default=False,
-                        help='By default, we delete all the files if an error '
-                        'occurs. Use that flag to keep whatever files have '
-                        'been saved so far in the event of an error')
+                        help='Kept for backward compatibility, that\'s now '
+                        'the default (see --delete-on-crash)')
+    parser.add_argument('--delete-on-crash', dest='delete_on_crash',
+                        action='store_const', const=True, default=False,
+                        help='By default, if an error occurs, we keep '
+                        'whatever files have been saved so far, so that the '
+                        'session can be resumed later (see --resume). Use '
+                        'that flag to delete them instead')
+    parser.add_argument('--resume', dest='resume', type=str, nargs=1,
+                        default=None, metavar='session',
+                        help='Resume that session (the name of its directory)'
+                        ' after a crash, skipping the users and documents '
+                        'that had already been backed up')
     parser.add_argument('--preferred-formats', dest='preferred_formats',
                         metavar='extension', type=str, nargs='+', default=[],
                         help='When several formats are available, if one (or '
@@ -81,6 +93,40 @@ def main():
                         'backup huge documents on a machine with little RAM. '
                         'Please do note that this might also have a negative '
                         'impact on performance if you use compression.')
+    parser.add_argument('--workers', dest='workers', type=int,
+                        required=False, default=1, metavar='N',
+                        help='Number of users to back up concurrently '
+                        '(defaults to 1). If a user fails, the others '
+                        'will still be backed up, but the exit code will '
+                        'be non-zero')
+    parser.add_argument('--download-threads', dest='download_threads',
+                        type=int, required=False, default=None, metavar='N',
+                        help='Number of threads downloading each user\'s '
+                        'documents in parallel (defaults to 1). See also the '
+                        '\'pipeline\' section of the settings file')
+    parser.add_argument('--full', dest='full',
+                        action='store_const', const=True, default=False,
+                        help='By default, documents that haven\'t changed '
+                        'since the previous backup are copied from it instead '
+                        'of being downloaded again. Use that flag to download '
+                        'everything')
+    parser.add_argument('--changes', dest='changes',
+                        action='store_const', const=True, default=False,
+                        help='If activated, Brive will only ask Google for '
+                        'the documents that changed since each user\'s '
+                        'previous backup, and re-use the previous backup for '
+                        'the other ones. Users with no previous backup (or '
+                        'if used with --full) get all their docs listed')
+    parser.add_argument('--restore', dest='restore', type=str, nargs=2,
+                        default=None, metavar=('login', 'doc_id'),
+                        help='Extract the files of that doc from the most '
+                        'recent backup of that user to the current '
+                        'directory, then exit (that\'s instant with zip '
+                        'archives, see the \'backend\' section of the '
+                        'settings file)')
+    parser.add_argument('--find', dest='find', type=str, nargs=1,
+                        default=None, metavar='doc_id',
+                        help='List all the backups of that doc, then exit')
     args = parser.parse_args()
 
     # load the logger functions
@@ -96,8 +142,20 @@ def main():
     if args.users and args.user_regex:
         Log.error('The options -u and --user-regex cannot be used together')
         exit(1)
+    if args.workers < 1:
+        Log.error('The number of workers should be a positive integer')
+        exit(1)
+    if args.download_threads is not None and args.download_threads < 1:
+        Log.error('The number of download threads should be a positive '
+                  'integer')
+        exit(1)
+    if args.keep_on_crash and args.delete_on_crash:
+        Log.error('The options --keep-on-crash and --delete-on-crash cannot '
+                  'be used together')
+        exit(1)
 
     backend = None
+    failures = None
     try:
         # build the config
         configuration = Configuration(SettingsFiles.SETTINGS_FILE,
@@ -111,6 +169,30 @@ def main():
                              for fmt in Configuration.get('formats_exclusive')]
         Configuration.set('formats_preferred', preferred_formats)
         Configuration.set('formats_exclusive', exclusive_formats)
+        if args.full:
+            Configuration.set('backend_incremental', 'False')
+        if args.download_threads is not None:
+            Configuration.set('pipeline_download_threads',
+                              str(args.download_threads))
+        if args.resume:
+            Configuration.set('backend_resume_session', args.resume[0])
+
+        if args.restore:
+            # just extract that doc, and exit
+            for path in restore_document(args.restore[0], args.restore[1],
+                                         os.getcwd()):
+                print path
+            return
+
+        if args.find:
+            # just display where that doc has been saved, and exit
+            for backup in find_document(args.find[0]):
+                for file_entry in backup['files']:
+                    print u'{}\t{}\t{}\t{}'.format(
+                        backup['session'], backup['login'],
+                        file_entry['path'], file_entry['member'] or ''
+                    )
+            return
 
         # down to business
         client = Client(args.keep_dirs, args.streaming_http)
@@ -131,15 +213,32 @@ def main():
         backend = configuration.get_backend(args.keep_dirs)
         if args.docs:
             # sepecific doc_ids, only one user
-            for doc_id in args.docs:
-                users[0].retrieve_single_document(backend, doc_id)
+            users[0].retrieve_documents(backend, args.docs)
+        elif args.workers > 1:
+            # general use case, several users at a time
+            scheduler = UserScheduler(client, backend, args.workers,
+                                      args.keep_dirs, args.owned_only,
+                                      args.changes)
+            failures = scheduler.run(users)
         else:
             # general use case
             for user in users:
-                user.save_documents(backend, args.owned_only)
+                user.save_documents(backend, args.owned_only, args.changes)
 
         Log.verbose('All successful, finalizing backend...')
         backend.finalize()
+        client.save_token_cache()
+        Log.verbose(u'Access tokens: {refreshes} refreshed, {reuses} re-used'
+                    .format(**client.token_stats))
+        Log.verbose(u'Connections: {created} Http objects created for '
+                    '{requests} requests, {reuse_rate:.0%} of which re-used a '
+                    'connection'.format(**client.connection_stats))
+        Log.verbose(u'Rate limiting: waited {waits} times, for '
+                    '{wait_time:.0f}s in total'
+                    .format(**client.rate_limit_stats))
+        Log.verbose(u'Concurrency: limit raised {increases} times, lowered '
+                    '{decreases} times, ended at {limit}'
+                    .format(**client.concurrency_stats))
 
         # delete the old backups, if so asked
         if args.age_limit:
@@ -148,20 +247,25 @@ def main():
     except BaseException as ex:
         if backend:
             try:
-                if args.keep_on_crash:
-                    Log.verbose(
-                        'Unexpected shutdown, trying to finalize backend...' +
-                        ' (you selected --keep-on-crash)'
-                    )
-                    backend.finalize()
-                else:
+                if args.delete_on_crash:
                     backend.clean_up()
+                else:
+                    Log.verbose('Unexpected shutdown, suspending backend...')
+                    backend.suspend()
             except:
                 pass
         if hasattr(ex, 'brive_explanation'):
             print u'### {} ###'.format(ex.brive_explanation)
         raise
 
+    if failures:
+        # the other users have been backed up, but still report the failure
+        for login, ex in failures.items():
+            explanation = getattr(ex, 'brive_explanation', repr(ex))
+            print u'### Failed to back up {}: {} ###'.format(login,
+                                                             explanation)
+        exit(1)
+
 
 if __name__ == '__main__':
     main()
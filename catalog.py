@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import threading
+import time
+
+from utils import *
+
+
+# a SQLite record of every session, of the users backed up during each of
+# them, and of the documents and files saved for those users, so that
+# finding a backup doesn't require walking the backups themselves
+# a single connection is shared by all threads (sqlite3 connections can't
+# be used concurrently, hence the lock)
+class Catalog(object):
+
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            name TEXT PRIMARY KEY,
+            started_at INTEGER NOT NULL,
+            finalized INTEGER NOT NULL DEFAULT 0
+        );
+        -- users get a row here once they're done (successfully, or at the
+        -- end of the session)
+        CREATE TABLE IF NOT EXISTS users (
+            session TEXT NOT NULL,
+            login TEXT NOT NULL,
+            PRIMARY KEY (session, login)
+        );
+        -- the files and dirs (relative to the root dir) making up a user's
+        -- backup during a session
+        CREATE TABLE IF NOT EXISTS user_paths (
+            session TEXT NOT NULL,
+            login TEXT NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (session, login, path)
+        );
+        CREATE TABLE IF NOT EXISTS documents (
+            session TEXT NOT NULL,
+            login TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            title TEXT,
+            mime_type TEXT,
+            modified_date TEXT,
+            md5_checksum TEXT,
+            file_size INTEGER,
+            formats TEXT,
+            PRIMARY KEY (session, login, doc_id)
+        );
+        CREATE INDEX IF NOT EXISTS documents_doc_id ON documents (doc_id);
+        -- path is the file's path relative to the root dir, or the archive's
+        -- if member is set
+        CREATE TABLE IF NOT EXISTS files (
+            session TEXT NOT NULL,
+            login TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            path TEXT NOT NULL,
+            member TEXT,
+            size INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS files_document
+            ON files (session, login, doc_id);
+    '''
+
+    # commit at least every that many documents
+    _COMMIT_EVERY = 1000
+
+    def __init__(self, path):
+        Log.debug(u'Opening catalog {}'.format(path))
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(self._SCHEMA)
+        self._lock = threading.Lock()
+        self._nb_uncommitted = 0
+
+    # resumed sessions keep their original start time
+    def start_session(self, session_name):
+        self._execute(
+            'INSERT OR IGNORE INTO sessions (name, started_at) VALUES (?, ?)',
+            (session_name, int(time.time())), commit=True
+        )
+
+    def finalize_session(self, session_name):
+        self._execute('UPDATE sessions SET finalized = 1 WHERE name = ?',
+                      (session_name, ), commit=True)
+
+    def has_session(self, session_name):
+        return bool(self._query('SELECT 1 FROM sessions WHERE name = ?',
+                                (session_name, )))
+
+    # entry is the document's manifest entry (see Manifest.make_entry), its
+    # files can have a 'member' key for files stored in archives
+    def add_document(self, session_name, login, doc_id, entry):
+        meta = entry['meta']
+        size = meta.get('fileSize')
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO documents VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (session_name, login, doc_id, meta.get('title'),
+                 meta.get('mimeType'), entry['modifiedDate'],
+                 entry['md5Checksum'], int(size) if size else None,
+                 ','.join(entry['formats']))
+            )
+            self._connection.execute(
+                'DELETE FROM files WHERE session = ? AND login = ? '
+                'AND doc_id = ?', (session_name, login, doc_id)
+            )
+            self._connection.executemany(
+                'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(session_name, login, doc_id, f['name'], f['path'],
+                  f.get('member'), f.get('size')) for f in entry['files']]
+            )
+            self._nb_uncommitted += 1
+            if self._nb_uncommitted >= self._COMMIT_EVERY:
+                self._commit()
+
+    # records that this user is done, and that their backup is made of
+    # those paths
+    def add_user(self, session_name, login, paths):
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO users VALUES (?, ?)',
+                (session_name, login)
+            )
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO user_paths VALUES (?, ?, ?)',
+                [(session_name, login, path) for path in paths]
+            )
+            self._commit()
+
+    # forgets everything about that user's backup during that session
+    def delete_user(self, session_name, login):
+        with self._lock:
+            for table in ('users', 'user_paths', 'documents', 'files'):
+                self._connection.execute(
+                    'DELETE FROM {} WHERE session = ? AND login = ?'
+                    .format(table), (session_name, login)
+                )
+            self._commit()
+
+    # forgets everything about that session
+    def delete_session(self, session_name):
+        with self._lock:
+            for table in ('users', 'user_paths', 'documents', 'files'):
+                self._connection.execute(
+                    'DELETE FROM {} WHERE session = ?'.format(table),
+                    (session_name, )
+                )
+            self._connection.execute('DELETE FROM sessions WHERE name = ?',
+                                     (session_name, ))
+            self._commit()
+
+    # returns the logins of the users backed up during that session
+    def get_logins(self, session_name):
+        return [row[0] for row in self._query(
+            'SELECT login FROM users WHERE session = ? ORDER BY login',
+            (session_name, )
+        )]
+
+    # returns the logins of the users that have documents saved during that
+    # session, but that haven't been added yet
+    def get_pending_logins(self, session_name):
+        return [row[0] for row in self._query(
+            'SELECT DISTINCT login FROM documents WHERE session = ? '
+            'AND login NOT IN (SELECT login FROM users WHERE session = ?) '
+            'ORDER BY login', (session_name, session_name)
+        )]
+
+    # returns the paths making up that user's backup during that session
+    def get_user_paths(self, session_name, login):
+        return [row[0] for row in self._query(
+            'SELECT path FROM user_paths WHERE session = ? AND login = ? '
+            'ORDER BY path', (session_name, login)
+        )]
+
+    # returns the backups of that doc (optionally only that user's ones),
+    # most recent first, as a list of dicts with 'session', 'login', 'title',
+    # 'modified_date' and 'files' keys (see add_document for the latter)
+    def find_document(self, doc_id, login=None):
+        query = 'SELECT session, login, title, modified_date ' \
+            'FROM documents WHERE doc_id = ?'
+        args = [doc_id]
+        if login is not None:
+            query += ' AND login = ?'
+            args.append(login)
+        query += ' ORDER BY session DESC, login'
+        result = []
+        for session_name, user_login, title, modified_date \
+                in self._query(query, args):
+            files = [
+                {'name': name, 'path': path, 'member': member, 'size': size}
+                for name, path, member, size in self._query(
+                    'SELECT name, path, member, size FROM files '
+                    'WHERE session = ? AND login = ? AND doc_id = ? '
+                    'ORDER BY rowid', (session_name, user_login, doc_id)
+                )
+            ]
+            result.append({'session': session_name, 'login': user_login,
+                           'title': title, 'modified_date': modified_date,
+                           'files': files})
+        return result
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._connection.close()
+
+    def _execute(self, statement, args, commit=False):
+        with self._lock:
+            self._connection.execute(statement, args)
+            if commit:
+                self._commit()
+
+    def _query(self, query, args):
+        with self._lock:
+            return self._connection.execute(query, args).fetchall()
+
+    # must be called with the lock held
+    def _commit(self):
+        self._connection.commit()
+        self._nb_uncommitted = 0
@@ -15,12 +15,20 @@ class ExpectedFailedRequestException(Exception):
 import feedparser
 
 import re
+import os
+import time
+import json
+import threading
+import Queue
+import datetime
+from collections import deque
 import streaming_httplib2
+import httplib2
 from httplib2 import Http as StandardHttp
 from OpenSSL.crypto import Error as CryptoError
 from oauth2client.client import \
-    SignedJwtAssertionCredentials, AccessTokenRefreshError
-from apiclient.discovery import build
+    SignedJwtAssertionCredentials, AccessTokenRefreshError, EXPIRY_FORMAT
+from apiclient.discovery import build_from_document, DISCOVERY_URI
 
 from model import User, Document, Folder
 from utils import *
@@ -69,6 +77,398 @@ class StreamingHttp(streaming_httplib2.Http):
         return (headers, content)
 
 
+# a pool of Http objects, shared by all the clients
+# each Http object keeps its connections alive, so borrowing one that
+# already talked to the same host saves a new TLS handshake
+class ConnectionPool(object):
+
+    def __init__(self, streaming, max_size):
+        self._streaming = streaming
+        # how many idle Http objects we keep around at most
+        self._max_size = max_size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._nb_created = 0
+        self._nb_requests = 0
+        self._nb_reused_connections = 0
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self._nb_created += 1
+        return StreamingHttp() if self._streaming else StandardHttp()
+
+    # reusable should be set to False if the connections are in an unknown
+    # state (e.g. a response that hasn't been read completely)
+    def release(self, http, reusable=True):
+        if reusable:
+            with self._lock:
+                if len(self._idle) < self._max_size:
+                    self._idle.append(http)
+                    return
+        self._close(http)
+
+    # to be called before each request, to keep track of how often
+    # we can re-use an already opened connection
+    def record_request(self, http, uri):
+        scheme, authority, _, _ = httplib2.urlnorm(uri)
+        with self._lock:
+            self._nb_requests += 1
+            if u'{}:{}'.format(scheme, authority) in http.connections:
+                self._nb_reused_connections += 1
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'created': self._nb_created,
+                'idle': len(self._idle),
+                'requests': self._nb_requests,
+                'reuse_rate': float(self._nb_reused_connections)
+                / max(self._nb_requests, 1)
+            }
+
+    @staticmethod
+    def _close(http):
+        for connection in http.connections.values():
+            try:
+                connection.close()
+            except Exception:
+                pass
+        http.connections.clear()
+
+
+# paces the requests so that they stay within Google's quotas, which are
+# given in requests per 100 seconds, both for each user and for the whole
+# project: we keep one token bucket per user, plus one for the project, and
+# a request has to get a token from both before being sent
+# that's shared by all the clients, so that it applies to all the threads
+class RateLimiter(object):
+
+    # Google's quotas are given over that many seconds
+    _QUOTA_PERIOD = 100.
+
+    # budgets are the numbers of requests allowed per 100 seconds, None or 0
+    # means no limit
+    def __init__(self, per_user_budget, per_project_budget):
+        self._per_user_budget = per_user_budget
+        self._project_bucket = self._new_bucket(per_project_budget)
+        # maps the users' email addresses to their buckets
+        self._user_buckets = dict()
+        self._lock = threading.Lock()
+        self._nb_waits = 0
+        self._total_wait = 0.
+
+    # blocks until nb_requests requests can be sent on behalf of that user
+    # (None if they're not sent on behalf of anyone, e.g. when validating
+    # the app)
+    def acquire(self, user, nb_requests=1):
+        with self._lock:
+            buckets = [self._project_bucket]
+            if user is not None:
+                if user not in self._user_buckets:
+                    self._user_buckets[user] = \
+                        self._new_bucket(self._per_user_budget)
+                buckets.append(self._user_buckets[user])
+            buckets = [bucket for bucket in buckets if bucket is not None]
+            if not buckets:
+                return
+            now = time.time()
+            delay = max(bucket.get_delay(now, nb_requests)
+                        for bucket in buckets)
+            # the tokens are taken right away, even though we're going to
+            # wait for them, so that the next threads queue up behind us
+            for bucket in buckets:
+                bucket.take(nb_requests)
+            if delay > 0:
+                self._nb_waits += 1
+                self._total_wait += delay
+        if delay > 0:
+            Log.debug(u'Rate limiting, waiting {:.2f}s'.format(delay))
+            time.sleep(delay)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'waits': self._nb_waits, 'wait_time': self._total_wait}
+
+    def _new_bucket(self, budget):
+        if not budget:
+            return None
+        # only allow bursts of one second's worth of requests, so that we
+        # can't go over the budget over any period of 100 seconds by much
+        rate = budget / self._QUOTA_PERIOD
+        return _TokenBucket(rate, max(rate, 1.))
+
+
+# must only be used with the rate limiter's lock held
+class _TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        # how many tokens we get per second
+        self._rate = rate
+        self._capacity = capacity
+        # can go negative, when requests are waiting for their tokens
+        self._tokens = capacity
+        self._last_update = time.time()
+
+    # returns how long to wait (in seconds) for the next nb_tokens tokens
+    def get_delay(self, now, nb_tokens):
+        self._tokens = min(self._capacity, self._tokens
+                           + (now - self._last_update) * self._rate)
+        self._last_update = now
+        return max(0., (nb_tokens - self._tokens) / self._rate)
+
+    def take(self, nb_tokens):
+        self._tokens -= nb_tokens
+
+
+# adapts how many requests can be in the air at once (all threads together)
+# to how well Google copes with them, the way TCP does with its congestion
+# window: the limit grows by one every time that many requests succeeded in
+# a row (additive increase), and is halved every time Google pushes back
+# with a rate limiting 403, a 429 or a 5xx (multiplicative decrease)
+# it also stops growing as long as the requests take much longer than
+# they used to, since that's usually a sign we're about to be throttled
+# a request only counts until its response's headers arrive: streamed
+# bodies (i.e. most downloads) are read after that, and aren't limited
+class ConcurrencyController(object):
+
+    _DECREASE_FACTOR = 0.5
+    # the weight of each new request in the latency's moving average
+    _LATENCY_WEIGHT = 0.1
+    # the limit only grows if the average latency is less than that many
+    # times the best one seen so far
+    _LATENCY_TOLERANCE = 2.
+    # where the limit starts from, Google copes with that many requests
+    # just fine
+    _INITIAL_LIMIT = 8
+    # how long to wait for some room at once, so that the waiting threads
+    # can still be interrupted
+    _WAIT_TIMEOUT = 1
+
+    def __init__(self, floor, ceiling):
+        self._floor = max(floor or 4, 1)
+        self._ceiling = max(ceiling or self._floor, self._floor)
+        # a float, so that it can grow by a fraction at every success
+        self._limit = float(
+            min(max(self._INITIAL_LIMIT, self._floor), self._ceiling)
+        )
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._latency = None
+        self._best_latency = None
+        # when the limit was last decreased: the requests that were sent
+        # before that don't get to decrease it again
+        self._last_decrease = 0
+        self._nb_increases = 0
+        self._nb_decreases = 0
+
+    # blocks until there's room for one more request, and returns
+    # a token to give back to release
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait(self._WAIT_TIMEOUT)
+            self._in_flight += 1
+        return time.time()
+
+    # status is the response's status, or None if the request failed
+    # before getting one; content is the body of 403 responses, since only
+    # those about rate limits mean Google is struggling (and not that the
+    # user can't access some document)
+    def release(self, token, status, content=None):
+        now = time.time()
+        with self._condition:
+            # was the limit actually reached?
+            saturated = self._in_flight >= int(self._limit)
+            self._in_flight -= 1
+            if status is None:
+                pass
+            elif status == 403 and \
+                    'ratelimitexceeded' not in (content or '').lower():
+                pass
+            elif status in (403, 429) or status >= 500:
+                if token >= self._last_decrease:
+                    self._decrease(status, now)
+            else:
+                self._update_latency(now - token)
+                if saturated and self._latency <= \
+                        self._best_latency * self._LATENCY_TOLERANCE:
+                    self._increase()
+            self._condition.notify_all()
+
+    @property
+    def stats(self):
+        with self._condition:
+            return {'limit': int(self._limit),
+                    'increases': self._nb_increases,
+                    'decreases': self._nb_decreases}
+
+    # must be called with the lock held
+    def _increase(self):
+        previous = int(self._limit)
+        self._limit = min(self._limit + 1. / previous, self._ceiling)
+        if int(self._limit) > previous:
+            self._nb_increases += 1
+            Log.verbose(u'Raising the concurrency limit to {} (average '
+                        'latency: {:.2f}s)'.format(int(self._limit),
+                                                   self._latency))
+
+    # must be called with the lock held
+    def _decrease(self, status, now):
+        previous = int(self._limit)
+        self._limit = max(self._limit * self._DECREASE_FACTOR, self._floor)
+        self._last_decrease = now
+        if int(self._limit) < previous:
+            self._nb_decreases += 1
+            Log.verbose(u'Got a {} response, lowering the concurrency limit '
+                        'to {}'.format(status, int(self._limit)))
+
+    # must be called with the lock held
+    def _update_latency(self, latency):
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += self._LATENCY_WEIGHT * (latency - self._latency)
+        if self._best_latency is None or self._latency < self._best_latency:
+            self._best_latency = self._latency
+
+
+# a streamed response's body, giving its Http object back to the pool
+# once it's been read completely or closed
+class _PooledStream(object):
+
+    def __init__(self, stream, pool, http):
+        self._stream = stream
+        self._pool = pool
+        self._http = http
+
+    def read(self, *args):
+        result = self._stream.read(*args)
+        if not result or not args:
+            # we're at the end of the response
+            self._release(True)
+        return result
+
+    def close(self):
+        # the connection can't be re-used if the response wasn't read
+        # completely
+        is_closed = getattr(self._stream, 'isclosed', None)
+        self._release(bool(is_closed and is_closed()))
+        self._stream.close()
+
+    def _release(self, reusable):
+        if self._http is not None:
+            self._pool.release(self._http, reusable)
+            self._http = None
+
+
+# what clients (and Google's code) use as an Http object: it borrows an
+# actual Http object from the pool for each request, and applies the
+# current user's credentials to it
+class PooledHttp(object):
+
+    def __init__(self, pool, rate_limiter, concurrency):
+        self._pool = pool
+        self._rate_limiter = rate_limiter
+        self._concurrency = concurrency
+        # Google's batch requests look for the credentials on the request
+        # method itself, the way oauth2client's authorize() sets them
+        self.request = _AuthorizedRequest(self._request)
+        # the email address of the user the requests are sent for, if any
+        self.user = None
+
+    @property
+    def credentials(self):
+        return self.request.credentials
+
+    @credentials.setter
+    def credentials(self, credentials):
+        self.request.credentials = credentials
+
+    @staticmethod
+    def encode_streaming_method(method):
+        return StreamingHttp.encode_streaming_method(method)
+
+    def _request(self, uri, method='GET', body=None, headers=None,
+                 redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+                 connection_type=None):
+        headers = dict(headers) if headers else dict()
+        credentials = self.credentials
+        http = self._pool.acquire()
+        reusable = False
+        try:
+            if credentials and credentials.access_token_expired:
+                credentials.refresh(StandardHttp())
+            for attempt in range(2):
+                if credentials:
+                    credentials.apply(headers)
+                self._rate_limiter.acquire(self.user)
+                self._pool.record_request(http, uri)
+                token = self._concurrency.acquire()
+                status = None
+                content = None
+                try:
+                    response, content = http.request(
+                        uri, method, body, headers, redirections,
+                        connection_type
+                    )
+                    status = response.status
+                    if status == 403 and hasattr(content, 'read'):
+                        # we need to know why, and error messages are short
+                        content = content.read()
+                finally:
+                    self._concurrency.release(token, status, content)
+                if response.status != 401 or not credentials or attempt:
+                    break
+                # the token might have been revoked, get a new one
+                # and try again
+                if hasattr(content, 'read'):
+                    content.read()
+                credentials.refresh(StandardHttp())
+            if hasattr(content, 'read'):
+                # the Http object will go back to the pool once the stream
+                # has been read
+                content = _PooledStream(content, self._pool, http)
+                http = None
+            reusable = True
+            return (response, content)
+        finally:
+            if http is not None:
+                self._pool.release(http, reusable)
+
+
+# PooledHttp's request method, carrying the credentials it applies
+class _AuthorizedRequest(object):
+
+    def __init__(self, request):
+        self._request = request
+        self.credentials = None
+
+    def __call__(self, *args, **kwargs):
+        return self._request(*args, **kwargs)
+
+
+# lets the Credentials keep track of how many times tokens get refreshed,
+# including when oauth2client does it on its own after a 401
+class _SignedAssertion(SignedJwtAssertionCredentials):
+
+    # called with this object every time a new token has been obtained
+    brive_on_refresh = None
+
+    # tokens are always fetched outside of the pool, without the expired
+    # token; Google's batch requests otherwise refresh through PooledHttp
+    def refresh(self, http):
+        super(_SignedAssertion, self).refresh(StandardHttp())
+
+    def _refresh(self, http_request):
+        super(_SignedAssertion, self)._refresh(http_request)
+        if self.brive_on_refresh:
+            self.brive_on_refresh(self)
+
+
 class Credentials(object):
 
     def __init__(self, http):
@@ -76,9 +476,23 @@ class Credentials(object):
             Configuration.get('google_app_email', 'google_app_p12_file',
                               'google_app_p12_secret', 'google_api_scopes',
                               not_null=True)
+        self._refresh_margin = Configuration.get(
+            'google_app_token_refresh_margin', is_int=True
+        ) or 0
+        self._cache_file = Configuration.get('google_app_token_cache_file')
         stream = open(p12_file, 'r')
         self._p12 = stream.read()
         stream.close()
+        self._lock = threading.Lock()
+        # maps impersonated email addresses to their signed assertions
+        self._assertions = dict()
+        # maps impersonated email addresses to the locks held while getting
+        # them a new token, so that only one thread does
+        self._refresh_locks = dict()
+        self._nb_refreshes = 0
+        self._nb_reuses = 0
+        self._last_save = 0
+        self._load_cache()
         # check our credentials are those of a valid app
         self._valid(http, True)
 
@@ -104,22 +518,259 @@ class Credentials(object):
         return False
 
     def get_signed_assertion(self, **kwargs):
-        return SignedJwtAssertionCredentials(self._email,
-                                             self._p12,
-                                             self._scopes,
-                                             self._p12_secret,
-                                             **kwargs)
+        result = _SignedAssertion(self._email,
+                                  self._p12,
+                                  self._scopes,
+                                  self._p12_secret,
+                                  **kwargs)
+        result.brive_on_refresh = self._on_refresh
+        return result
+
+    # returns a signed assertion for that email address with a valid
+    # access token, only getting a new token if the current one is
+    # about to expire
+    def get_cached_assertion(self, email):
+        with self._lock:
+            assertion = self._assertions.get(email)
+            if assertion is None:
+                assertion = self.get_signed_assertion(prn=email)
+                self._assertions[email] = assertion
+            refresh_lock = self._refresh_locks.setdefault(email,
+                                                          threading.Lock())
+        with refresh_lock:
+            # another thread might have just done it
+            if self._needs_refresh(assertion):
+                Log.debug(u'Getting a new access token for {}'.format(email))
+                self._refresh(assertion)
+                return assertion
+        with self._lock:
+            self._nb_reuses += 1
+        return assertion
+
+    # an invalid assertion won't get any better by retrying
+    @staticmethod
+    @RetryPolicy('token', AccessTokenRefreshError)
+    def _refresh(assertion):
+        assertion.refresh(StandardHttp())
+
+    # returns a dict of counters about access tokens
+    @property
+    def stats(self):
+        with self._lock:
+            return {'refreshes': self._nb_refreshes,
+                    'reuses': self._nb_reuses}
+
+    def _needs_refresh(self, assertion):
+        if not assertion.access_token or not assertion.token_expiry:
+            return True
+        time_left = assertion.token_expiry - datetime.datetime.utcnow()
+        return time_left < datetime.timedelta(seconds=self._refresh_margin)
+
+    # don't re-write the on-disk cache more often than that (in seconds)
+    _CACHE_SAVE_INTERVAL = 60
+
+    def _on_refresh(self, assertion):
+        with self._lock:
+            self._nb_refreshes += 1
+            save = time.time() - self._last_save > self._CACHE_SAVE_INTERVAL
+        if save:
+            self.save_cache()
+
+    # the on-disk cache is only valid for the same app and scopes
+    def _get_cache_header(self):
+        return {'app': self._email, 'scopes': sorted(self._scopes)}
+
+    def _load_cache(self):
+        if not self._cache_file:
+            return
+        try:
+            with open(self._cache_file, 'r') as stream:
+                data = json.load(stream)
+        except (IOError, ValueError):
+            # no cache yet, or a corrupted one
+            return
+        if data.get('header') != self._get_cache_header():
+            Log.verbose('Ignoring access tokens cached for another app')
+            return
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            for email, token in data.get('tokens', {}).items():
+                try:
+                    expiry = datetime.datetime.strptime(token['expiry'],
+                                                        EXPIRY_FORMAT)
+                except (KeyError, ValueError):
+                    continue
+                if expiry <= now:
+                    continue
+                assertion = self.get_signed_assertion(prn=email)
+                assertion.access_token = token['access_token']
+                assertion.token_expiry = expiry
+                self._assertions[email] = assertion
+            Log.debug(u'Loaded {} cached access tokens'
+                      .format(len(self._assertions)))
+
+    # writes the current tokens to the on-disk cache, if any
+    def save_cache(self):
+        if not self._cache_file:
+            return
+        with self._lock:
+            self._last_save = time.time()
+            tokens = {
+                email: {
+                    'access_token': assertion.access_token,
+                    'expiry': assertion.token_expiry.strftime(EXPIRY_FORMAT)
+                }
+                for email, assertion in self._assertions.items()
+                if assertion.access_token and assertion.token_expiry
+            }
+            data = {'header': self._get_cache_header(), 'tokens': tokens}
+            tmp_path = self._cache_file + '.tmp'
+            try:
+                # those tokens grant access to the users' data!
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0600)
+                with os.fdopen(fd, 'w') as stream:
+                    json.dump(data, stream)
+                os.rename(tmp_path, self._cache_file)
+            except (IOError, OSError) as ex:
+                Log.error(u'Could not save access tokens to {}: {}'
+                          .format(self._cache_file, ex), with_BT=False)
+
+
+# caches Google's API discovery documents, both in memory and on the disk
+# so that we don't have to fetch them from Google every time we need
+# to build a service
+class DiscoveryCache(object):
+
+    _lock = threading.Lock()
+    # maps (service name, version) tuples to (timestamp, document) tuples
+    _documents = dict()
+
+    # returns the discovery document for that API as a JSON string
+    @classmethod
+    def get(cls, service_name, version):
+        key = (service_name, version)
+        ttl = Configuration.get('google_api_discovery_cache_ttl', is_int=True)
+        with cls._lock:
+            if key in cls._documents:
+                timestamp, document = cls._documents[key]
+                if time.time() - timestamp < ttl:
+                    return document
+        # don't hold the lock while fetching, the other APIs' documents
+        # might be in the cache
+        timestamp, document = cls._load_from_disk(service_name, version)
+        if document is None or time.time() - timestamp >= ttl:
+            try:
+                fetched = cls._fetch(service_name, version)
+            except Exception as ex:
+                if document is None:
+                    raise
+                # an outdated document is better than none, and there's
+                # no need to try again before the ttl is over
+                Log.error(u'Could not fetch the discovery document for {} '
+                          .format(service_name) + u'{}, using the expired '
+                          .format(version) + u'cached one: {}'.format(ex),
+                          with_BT=False)
+            else:
+                document = fetched
+                cls._save_to_disk(service_name, version, document)
+            timestamp = time.time()
+        with cls._lock:
+            cls._documents[key] = (timestamp, document)
+        return document
+
+    @staticmethod
+    def _get_path(service_name, version):
+        cache_dir = Configuration.get('google_api_discovery_cache_dir')
+        if not cache_dir:
+            return None
+        cache_dir = os.path.join(SettingsFiles.base_dir, cache_dir)
+        return os.path.join(cache_dir, u'{}.{}.json'.format(service_name,
+                                                            version))
+
+    @classmethod
+    def _load_from_disk(cls, service_name, version):
+        path = cls._get_path(service_name, version)
+        try:
+            timestamp = os.path.getmtime(path)
+            with open(path, 'r') as stream:
+                document = stream.read()
+            # make sure it's not corrupted
+            json.loads(document)
+            return (timestamp, document)
+        except (TypeError, IOError, OSError, ValueError):
+            return (None, None)
+
+    @classmethod
+    def _save_to_disk(cls, service_name, version, document):
+        path = cls._get_path(service_name, version)
+        if path is None:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # write to a temp file first, so that we never leave a
+            # half-written document behind
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as stream:
+                stream.write(document)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as ex:
+            # not a big deal, we'll just have to fetch it next time
+            Log.error(u'Could not cache discovery document to {}: {}'
+                      .format(path, ex), with_BT=False)
+
+    @staticmethod
+    @RetryPolicy('discovery')
+    def _fetch(service_name, version):
+        uri = DISCOVERY_URI.format(api=service_name, apiVersion=version)
+        Log.debug(u'Fetching discovery document from {}'.format(uri))
+        headers, content = StandardHttp().request(uri)
+        status = int(headers.get('status', 0))
+        if status != 200:
+            ex = FailedRequestException(
+                u'Could not fetch discovery document from {} '.format(uri) +
+                u'(return code: {})'.format(status)
+            )
+            # see RetryPolicy
+            ex.brive_status = status
+            raise ex
+        # make sure it's valid JSON before caching it
+        json.loads(content)
+        return content
 
 
 class Client(object):
 
     # FIXME: check extended scopes, and see that we fail,
     # otherwise issue a warning
-    def __init__(self, keep_dirs, streaming):
+    def __init__(self, keep_dirs, streaming, creds=None, pool=None,
+                 rate_limiter=None, concurrency=None):
         self._keep_dirs = keep_dirs
         self._streaming = streaming
-        self._reset()
-        self._creds = Credentials(self._http)
+        # the pool is shared between clients, but each client has its own
+        # Http object holding the credentials of the user it's authorized for
+        self._pool = pool or ConnectionPool(
+            streaming, Configuration.get('http_pool_size', is_int=True)
+        )
+        # same for the rate limiter and the concurrency controller, since
+        # Google's quotas apply to all the threads together
+        self._rate_limiter = rate_limiter or RateLimiter(
+            *Configuration.get('google_quota_per_user',
+                               'google_quota_per_project', is_int=True)
+        )
+        self._concurrency = concurrency or ConcurrencyController(
+            *Configuration.get('http_concurrency_floor',
+                               'http_concurrency_ceiling', is_int=True)
+        )
+        self._http = PooledHttp(self._pool, self._rate_limiter,
+                                self._concurrency)
+        # maps (service name, version) tuples to services built for
+        # this client, and re-used for all the users
+        self._services = dict()
+        # credentials can be shared between clients, since they're only
+        # used to generate new signed assertions
+        self._creds = creds or Credentials(self._http)
         self._domain, admin_login, \
             self._drive_service_name, self._drive_service_version, \
             self._users_service_name, self._users_service_version = \
@@ -133,14 +784,19 @@ class Client(object):
         self._admin = User(admin_login, self, False)
         Log.debug('Client loaded')
 
+    # returns a new client with the same credentials and connection pool,
+    # but its own authorization state, so that both can be used
+    # concurrently in different threads
+    def clone(self):
+        return Client(self._keep_dirs, self._streaming, self._creds,
+                      self._pool, self._rate_limiter, self._concurrency)
+
     # authorizes the given user
     def authorize(self, user):
         Log.debug(u'Authorizing client for {}'.format(user.login))
-        self._reset()
-        signed_assertion = self._creds.get_signed_assertion(
-            prn=self._get_email_address(user)
-        )
-        signed_assertion.authorize(self._http)
+        email = self._get_email_address(user)
+        self._http.credentials = self._creds.get_cached_assertion(email)
+        self._http.user = email
 
     def authorize_admin(self):
         return self.authorize(self._admin)
@@ -149,6 +805,35 @@ class Client(object):
     def streaming(self):
         return self._streaming
 
+    # counters about the access tokens, shared with all the clones
+    @property
+    def token_stats(self):
+        return self._creds.stats
+
+    def save_token_cache(self):
+        self._creds.save_cache()
+
+    # counters about the connection pool, shared with all the clones
+    @property
+    def connection_stats(self):
+        return self._pool.stats
+
+    # accounts for requests that Google counts as several ones (e.g. the
+    # sub requests of a batch request), on top of the one for the actual
+    # HTTP request
+    def acquire_quota(self, nb_requests):
+        self._rate_limiter.acquire(self._http.user, nb_requests)
+
+    # counters about the rate limiter, shared with all the clones
+    @property
+    def rate_limit_stats(self):
+        return self._rate_limiter.stats
+
+    # counters about the concurrency controller, shared with all the clones
+    @property
+    def concurrency_stats(self):
+        return self._concurrency.stats
+
     @property
     def drive_service(self):
         return self._build_service(
@@ -186,9 +871,17 @@ class Client(object):
         return [login for login in UserGenerator(self, self._domain)]
 
     def _build_service(self, service_name, api_version):
-        return build(service_name, api_version, self._http)
+        key = (service_name, api_version)
+        if key not in self._services:
+            Log.debug(u'Building service {} {}'.format(service_name,
+                                                       api_version))
+            self._services[key] = build_from_document(
+                DiscoveryCache.get(service_name, api_version),
+                http=self._http
+            )
+        return self._services[key]
 
-    @Utils.multiple_tries_decorator(ExpectedFailedRequestException)
+    # not retried here, that's up to the callers (see DocumentContent)
     def request(self, uri, method='GET', *args, **kwargs):
         # pop a few internal kwargs
         expected_error_status = kwargs.pop('brive_expected_error_status', [])
@@ -203,42 +896,49 @@ class Client(object):
         status = int(headers.get('status', 0))
         if status != 200:
             if status in expected_error_status:
-                raise ExpectedFailedRequestException(status)
+                ex = ExpectedFailedRequestException(status)
             else:
                 content = result[1]
                 if hasattr(content, 'read'):
                     # a streamed content!
                     content = content.read()
-                raise FailedRequestException(
+                ex = FailedRequestException(
                     u'Http request failed (return code: {}, headers: {} '
                     .format(status, headers) +
                     u'and content: {})'.format(content.decode('utf8'))
                 )
+            # see RetryPolicy
+            ex.brive_status = status
+            ex.brive_retry_after = headers.get('retry-after')
+            raise ex
         return result
 
     def _get_email_address(self, user):
         return u'{}@{}'.format(user.login, self._domain)
 
-    def _reset(self):
-        if self._streaming:
-            self._http = StreamingHttp()
-        else:
-            self._http = StandardHttp()
-
 
 class ServiceListEnumerator(object):
 
     # sub classes must override these 2
     _service_object_name = None
     _items_field = None
+    # the largest page size the API allows, if any
+    _max_results = None
 
     def __iter__(self):
         self._current_page_nb = 0
-        self._current_page = []
+        self._current_page = deque()
         self._current_page_token = None
         self._next_page_token = None
         self._service = None
-        self._already_done_ids = []
+        # the ids of the current page's items that have been processed, in
+        # case we have to fetch that page again
+        self._already_done_ids = set()
+        # how many pages to fetch in advance, in the background
+        self._prefetch_depth = Configuration.get(
+            'pipeline_listing_prefetch_depth', is_int=True
+        ) or 0
+        self._prefetcher = None
         return self
 
     def _regenerate_service(self):
@@ -250,16 +950,23 @@ class ServiceListEnumerator(object):
     def _process_item(self, item):
         raise NotImplementedError()
 
-    @Utils.multiple_tries_decorator([ExpiredTokenException, StopIteration])
+    # the fields of each item we need (a partial response projection, see
+    # https://developers.google.com/drive/v2/web/performance#partial),
+    # None to get all of them
+    def _item_fields(self):
+        return None
+
     def next(self):
         return self._get_next()
 
     def add_processed_id(self, id):
-        self._already_done_ids.append(id)
+        self._already_done_ids.add(id)
 
     def reset_to_current_page(self):
+        # the pages fetched in advance follow the one we're leaving
+        self._stop_prefetching()
         self._next_page_token = self._current_page_token
-        self._current_page = []
+        self._current_page = deque()
         self._current_page_nb -= 1
 
     def _get_next(self, first_try=True):
@@ -282,7 +989,7 @@ class ServiceListEnumerator(object):
         if not self._current_page:
             self._fetch_next_page()
         try:
-            return self._current_page.pop(0)
+            return self._current_page.popleft()
         except IndexError:
             # no more docs to be fetched
             raise StopIteration
@@ -291,37 +998,146 @@ class ServiceListEnumerator(object):
         cls = self.__class__
 
         if not self._current_page_nb or self._next_page_token:
-            kwargs = self._list_kwargs()
-            if self._next_page_token:
-                kwargs['pageToken'] = self._next_page_token
-
-            service_object = getattr(self._service, cls._service_object_name)()
-            response = service_object.list(**kwargs).execute()
+            response = self._get_page(self._next_page_token)
 
             items = response[getattr(cls, '_items_field')]
             Log.debug('Retrieving page # {} : found {} items'
                       .format(self._current_page_nb, len(items)))
 
-            self._current_page = [
+            self._current_page = deque(
                 self._process_item(item) for item in items
                 if item['id'] not in self._already_done_ids
-            ]
+            )
 
             self._current_page_token = self._next_page_token
             self._next_page_token = response.get('nextPageToken')
             self._current_page_nb += 1
         else:
             # we're done
-            self._current_page = []
+            self._current_page = deque()
 
         # no need to keep the processed ids of the current page in memory
-        self._already_done_ids = []
+        self._already_done_ids = set()
+
+    # returns the response for the page with that token (None for the
+    # first one), fetched in advance if possible
+    def _get_page(self, page_token):
+        if not self._prefetch_depth:
+            return self._request_page(page_token)
+        if self._prefetcher is None:
+            self._prefetcher = _PagePrefetcher(
+                self._request_page, page_token, self._prefetch_depth
+            )
+        page = self._prefetcher.get()
+        if page is None or page.token != page_token or page.error:
+            # start over from that page next time (e.g. with a new
+            # service, if that's an expired token)
+            self._stop_prefetching()
+            if page is not None and page.error:
+                raise page.error
+            return self._get_page(page_token)
+        return page.response
+
+    # retried here rather than in next, so that each call is one request
+    # (see RetryPolicy's retry budget)
+    @RetryPolicy('list', ExpiredTokenException)
+    def _request_page(self, page_token):
+        cls = self.__class__
+        kwargs = self._list_kwargs()
+        if page_token:
+            kwargs['pageToken'] = page_token
+        if cls._max_results:
+            kwargs['maxResults'] = cls._max_results
+        item_fields = self._item_fields()
+        if item_fields:
+            kwargs['fields'] = u'nextPageToken,{}({})'.format(
+                cls._items_field, item_fields
+            )
+        service_object = getattr(self._service, cls._service_object_name)()
+        return service_object.list(**kwargs).execute()
+
+    def _stop_prefetching(self):
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+
+
+# fetches pages of a listing in a background thread, starting from a given
+# page and following the next page tokens, at most depth pages ahead of
+# what's been consumed
+class _PagePrefetcher(object):
+
+    # how long (in seconds) the thread waits for room in the queue before
+    # giving up (the enumerator might have been abandoned); get starts a
+    # new one if needed
+    _MAX_IDLE_TIME = 300
+    _WAIT_TIMEOUT = 1
+
+    # request_page is called with a page token, and returns the response
+    def __init__(self, request_page, page_token, depth):
+        self._request_page = request_page
+        self._pages = Queue.Queue(depth)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(page_token,),
+                                        name='page-prefetcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # returns the next _Page, or None if the thread gave up
+    def get(self):
+        while True:
+            try:
+                return self._pages.get(timeout=self._WAIT_TIMEOUT)
+            except Queue.Empty:
+                if not self._thread.is_alive():
+                    try:
+                        return self._pages.get_nowait()
+                    except Queue.Empty:
+                        return None
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self, page_token):
+        while not self._stopped.is_set():
+            try:
+                response = self._request_page(page_token)
+            except Exception as ex:
+                # that's for the consumer to handle
+                self._put(_Page(page_token, None, ex))
+                return
+            if not self._put(_Page(page_token, response)):
+                return
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    # returns false if the page couldn't be queued
+    def _put(self, page):
+        waited = 0
+        while not self._stopped.is_set() and waited < self._MAX_IDLE_TIME:
+            try:
+                self._pages.put(page, timeout=self._WAIT_TIMEOUT)
+                return True
+            except Queue.Full:
+                waited += self._WAIT_TIMEOUT
+        return False
+
+
+class _Page(object):
+
+    def __init__(self, token, response, error=None):
+        # the token used to get that page
+        self.token = token
+        self.response = response
+        self.error = error
 
 
 class UserGenerator(ServiceListEnumerator):
 
     _service_object_name = 'users'
     _items_field = 'users'
+    _max_results = 500
 
     def __init__(self, client, domain):
         self._client = client
@@ -334,6 +1150,9 @@ class UserGenerator(ServiceListEnumerator):
     def _list_kwargs(self):
         return {'domain': self._domain}
 
+    def _item_fields(self):
+        return 'id,primaryEmail'
+
     def _process_item(self, item):
         email = item['primaryEmail']
         return email.rsplit(u'@{}'.format(self._domain), 1)[0]
@@ -343,6 +1162,7 @@ class UserDocumentsGenerator(ServiceListEnumerator):
 
     _service_object_name = 'files'
     _items_field = 'items'
+    _max_results = 1000
 
     def __init__(self, user, query=None, cls=Document):
         self._user = user
@@ -360,5 +1180,34 @@ class UserDocumentsGenerator(ServiceListEnumerator):
             kwargs['q'] = self._query
         return kwargs
 
+    def _item_fields(self):
+        return self._class.get_fields_projection()
+
     def _process_item(self, item):
         return self._class(item, self._user.folders)
+
+
+class UserChangesGenerator(ServiceListEnumerator):
+
+    _service_object_name = 'changes'
+    _items_field = 'items'
+    _max_results = 1000
+
+    def __init__(self, user, start_change_id):
+        self._user = user
+        self._start_change_id = start_change_id
+
+    def _regenerate_service(self):
+        return self._user.drive_service
+
+    def _list_kwargs(self):
+        return {'startChangeId': str(self._start_change_id),
+                'includeDeleted': True}
+
+    def _item_fields(self):
+        return u'id,fileId,deleted,file({})'.format(
+            Document.get_fields_projection()
+        )
+
+    def _process_item(self, item):
+        return item
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import tarfile
+import Queue
+import collections
+import zlib
+import bz2
+
+
+# imports an optional module, with a clear error message if it's missing
+def _import_optional(format, module_names, package_name):
+    for module_name in module_names:
+        try:
+            return __import__(module_name, fromlist=['_'])
+        except ImportError:
+            pass
+    raise Exception(
+        u'The {} compression format requires the {} package, '.format(
+            format, package_name
+        ) + u'please install it (e.g. pip install {})'.format(package_name)
+    )
+
+
+# compressed in independent blocks, one stream per block: if several
+# threads are available, blocks get compressed in parallel (that's what
+# pigz, pbzip2 and xz -T do), and gzip, bzip2, xz and tar all know how
+# to read the resulting multi-stream files
+class _BlockFormat(object):
+
+    def check(self):
+        pass
+
+    def open_writer(self, fileobj, level, nb_threads):
+        return ParallelCompressor(fileobj, self, nb_threads, level)
+
+    def open_reader(self, fileobj):
+        return MultiStreamReader(fileobj, self)
+
+
+class _GzipFormat(_BlockFormat):
+
+    extension = 'gz'
+    magic = '\x1f\x8b'
+    block_size = 1048576  # 1 Mb
+    default_level = 9
+
+    def compress(self, data, level):
+        # a 16 + window size gets us gzip headers and trailers
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def new_decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class _Bz2Format(_BlockFormat):
+
+    extension = 'bz2'
+    magic = 'BZh'
+    # bz2's own maximum block size, so we lose nothing by splitting
+    block_size = 900000
+    default_level = 9
+
+    def compress(self, data, level):
+        return bz2.compress(data, level)
+
+    def new_decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+class _XzFormat(_BlockFormat):
+
+    extension = 'xz'
+    magic = '\xfd7zXZ\x00'
+    # xz's default dictionary size, blocks much smaller would hurt the ratio
+    block_size = 8388608  # 8 Mb
+    default_level = 6
+
+    # lzma is part of the standard library from Python 3.3 on
+    @property
+    def _lzma(self):
+        return _import_optional('xz', ['lzma', 'backports.lzma'],
+                                'backports.lzma')
+
+    def check(self):
+        self._lzma
+
+    def compress(self, data, level):
+        return self._lzma.compress(data, preset=level)
+
+    def new_decompressor(self):
+        return self._lzma.LZMADecompressor()
+
+
+# zstd does its own multi-threading, in one single frame
+class _ZstdFormat(object):
+
+    extension = 'zst'
+    magic = '\x28\xb5\x2f\xfd'
+    default_level = 3
+
+    @property
+    def _zstandard(self):
+        return _import_optional('zstd', ['zstandard'], 'zstandard')
+
+    def check(self):
+        self._zstandard
+
+    def open_writer(self, fileobj, level, nb_threads):
+        return _ZstdWriter(fileobj, self._zstandard, level, nb_threads)
+
+    def open_reader(self, fileobj):
+        return self._zstandard.ZstdDecompressor().stream_reader(fileobj)
+
+
+_FORMATS = {
+    'gz': _GzipFormat(),
+    'bz2': _Bz2Format(),
+    'xz': _XzFormat(),
+    'zstd': _ZstdFormat()
+}
+
+# the formats tarfile can handle on its own
+_TARFILE_FORMATS = ('gz', 'bz2')
+
+
+# returns the list of known compression formats
+def get_formats():
+    return sorted(_FORMATS.keys())
+
+
+# returns the list of the corresponding file extensions
+def get_extensions():
+    return sorted(format.extension for format in _FORMATS.values())
+
+
+def get_extension(format):
+    return _FORMATS[format].extension
+
+
+# raises an exception if that format can't be used here
+def check_format(format):
+    if format not in _FORMATS:
+        raise Exception(
+            u'The compression format must be one of {}, '.format(
+                ', '.join(get_formats())
+            ) + u'{} given'.format(format)
+        )
+    _FORMATS[format].check()
+
+
+# opens a tar archive to write to, compressed with nb_threads threads
+# level defaults to the format's own default
+def open_tarfile_for_writing(path, format, nb_threads, level=None):
+    if level is None:
+        level = _FORMATS[format].default_level
+    if nb_threads <= 1 and format in _TARFILE_FORMATS:
+        # tarfile can do it on its own
+        return tarfile.open(path, 'w:' + format, compresslevel=level)
+    compressor = _FORMATS[format].open_writer(open(path, 'wb'), level,
+                                              nb_threads)
+    try:
+        tar_file = _CompressedTarFile.open(fileobj=compressor, mode='w|')
+    except:
+        compressor.close()
+        raise
+    tar_file.brive_fileobj = compressor
+    return tar_file
+
+
+# opens a tar archive to read it sequentially
+# tarfile only reads the first stream of multi-stream compressed files, and
+# doesn't know about all of our formats, so we decompress them ourselves
+def open_tarfile_for_reading(path):
+    stream = open(path, 'rb')
+    try:
+        magic = stream.read(6)
+        stream.seek(0)
+        for format in _FORMATS.values():
+            if magic.startswith(format.magic):
+                reader = format.open_reader(stream)
+                tar_file = _CompressedTarFile.open(fileobj=reader, mode='r|')
+                tar_file.brive_fileobj = reader
+                return tar_file
+        # not compressed, or in a format we don't know about
+        stream.close()
+    except:
+        stream.close()
+        raise
+    return tarfile.open(path, 'r|*')
+
+
+# a tar file that also closes our (de)compressing file object when it's
+# closed (tarfile leaves file objects it's been given alone)
+class _CompressedTarFile(tarfile.TarFile):
+
+    def close(self):
+        try:
+            super(_CompressedTarFile, self).close()
+        finally:
+            fileobj = getattr(self, 'brive_fileobj', None)
+            if fileobj is not None:
+                fileobj.close()
+
+
+# a write-only file-like object that compresses what's written to it in
+# independent blocks, using several threads, and writes the resulting
+# multi-stream file to fileobj, in order
+# zlib, bz2 and lzma all release the GIL while compressing, so this does
+# use several cores
+class ParallelCompressor(object):
+
+    # how many blocks can be waiting to be written, per thread
+    _BLOCKS_PER_THREAD = 2
+
+    def __init__(self, fileobj, format, nb_threads, level):
+        self._fileobj = fileobj
+        self._format = format
+        self._level = level
+        self._nb_threads = nb_threads
+        self._buffer = []
+        self._buffer_size = 0
+        # the blocks submitted and not written yet, in order
+        self._pending = collections.deque()
+        self._jobs = Queue.Queue()
+        self._threads = []
+        for i in range(nb_threads):
+            thread = threading.Thread(target=self._compress_loop,
+                                      name='compressor-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._closed = False
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        block_size = self._format.block_size
+        if self._buffer_size >= block_size:
+            data = ''.join(self._buffer)
+            # only full blocks go out, the rest waits for more data
+            end = len(data) - len(data) % block_size
+            for start in range(0, end, block_size):
+                self._submit(data[start:start + block_size])
+            self._buffer = [data[end:]]
+            self._buffer_size = len(data) - end
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            # the last block might be smaller than the others, that's fine
+            if self._buffer_size:
+                self._submit(''.join(self._buffer))
+                self._buffer = []
+                self._buffer_size = 0
+            while self._pending:
+                self._write_next_block()
+        finally:
+            for _ in self._threads:
+                self._jobs.put(None)
+            self._fileobj.close()
+
+    def _submit(self, data):
+        block = _Block(data)
+        self._pending.append(block)
+        self._jobs.put(block)
+        # write whatever's ready, and wait for the oldest block if too many
+        # are in the air
+        while self._pending and (
+                self._pending[0].done.is_set() or len(self._pending)
+                > self._nb_threads * self._BLOCKS_PER_THREAD):
+            self._write_next_block()
+
+    def _write_next_block(self):
+        block = self._pending.popleft()
+        block.done.wait()
+        if block.error is not None:
+            raise block.error
+        self._fileobj.write(block.result)
+
+    def _compress_loop(self):
+        while True:
+            block = self._jobs.get()
+            if block is None:
+                return
+            try:
+                block.result = self._format.compress(block.data, self._level)
+            except Exception as ex:
+                block.error = ex
+            block.data = None
+            block.done.set()
+
+
+# zstandard's own writer, closing the frame and the file when closed
+class _ZstdWriter(object):
+
+    def __init__(self, fileobj, zstandard, level, nb_threads):
+        self._fileobj = fileobj
+        self._zstandard = zstandard
+        # 0 means compressing in the calling thread
+        compressor = zstandard.ZstdCompressor(
+            level=level, threads=nb_threads if nb_threads > 1 else 0
+        )
+        self._writer = compressor.stream_writer(fileobj)
+        self._closed = False
+
+    def write(self, data):
+        self._writer.write(data)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._writer.flush(self._zstandard.FLUSH_FRAME)
+        finally:
+            self._fileobj.close()
+
+
+class _Block(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+# a read-only file-like object decompressing a file made of one or several
+# consecutive compressed streams
+class MultiStreamReader(object):
+
+    _CHUNK_SIZE = 1048576  # 1 Mb
+
+    def __init__(self, fileobj, format):
+        self._fileobj = fileobj
+        self._format = format
+        self._decompressor = format.new_decompressor()
+        self._buffer = ''
+        # how much of the buffer has already been read
+        self._offset = 0
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and \
+                (size < 0 or len(self._buffer) - self._offset < size):
+            self._decompress_chunk()
+        if size < 0:
+            size = len(self._buffer) - self._offset
+        result = self._buffer[self._offset:self._offset + size]
+        self._offset += len(result)
+        return result
+
+    def close(self):
+        self._fileobj.close()
+
+    def _decompress_chunk(self):
+        chunk = self._fileobj.read(self._CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return
+        # get rid of what's already been read
+        pieces = [self._buffer[self._offset:]]
+        self._offset = 0
+        while chunk:
+            try:
+                pieces.append(self._decompressor.decompress(chunk))
+            except EOFError:
+                # bz2 complains when fed data after the end of its stream
+                self._decompressor = self._format.new_decompressor()
+                continue
+            # whatever comes after the end of a stream belongs to the next one
+            chunk = self._decompressor.unused_data
+            if chunk:
+                self._decompressor = self._format.new_decompressor()
+        self._buffer = ''.join(pieces)
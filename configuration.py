@@ -78,10 +78,19 @@ class Configuration(object):
     # returns the right backend depending on the configuration
     def get_backend(self, keep_dirs):
         compression = self.get('backend_compression', is_bool=True)
-        class_name = self.get('factories_tar_backend', not_null=True) \
-            if compression else self.get(
-                'factories_simple_backend', not_null=True
-            )
+        deduplicate = self.get('backend_deduplicate', is_bool=True)
+        if compression and deduplicate:
+            raise Exception('The backend can\'t both compress and '
+                            'de-duplicate files')
+        if deduplicate:
+            class_name = self.get('factories_dedup_backend', not_null=True)
+        elif compression and self.get('backend_compression_format') == 'zip':
+            class_name = self.get('factories_zip_backend', not_null=True)
+        else:
+            class_name = self.get('factories_tar_backend', not_null=True) \
+                if compression else self.get(
+                    'factories_simple_backend', not_null=True
+                )
         class_object = eval(class_name)
         return class_object(keep_dirs)
 
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import json
+import threading
+
+from utils import *
+
+
+# an append-only record of the work completed during a session, one JSON
+# object per line, so that the session can be resumed after a crash
+# (see --resume): each line is flushed as soon as it's written, and a line
+# cut short by a crash is simply ignored
+class Journal(object):
+
+    _DIR_NAME = '.journals'
+
+    # types of records
+    _DOCUMENT = 'document'
+    _USER = 'user'
+    _PART = 'part'
+
+    def __init__(self, root_dir, session_name):
+        self._path = self._get_path(root_dir, session_name)
+        try:
+            os.makedirs(os.path.dirname(self._path))
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        self._lock = threading.Lock()
+        self._stream = open(self._path, 'a')
+
+    @staticmethod
+    def _get_path(root_dir, session_name):
+        return os.path.join(root_dir, Journal._DIR_NAME,
+                            u'{}.jsonl'.format(session_name))
+
+    @staticmethod
+    def exists(root_dir, session_name):
+        return os.path.isfile(Journal._get_path(root_dir, session_name))
+
+    # entry is the document's manifest entry (see Manifest.make_entry)
+    def add_document(self, login, doc_id, entry):
+        self._write({'type': self._DOCUMENT, 'login': login,
+                     'doc_id': doc_id, 'entry': entry})
+
+    # that user has been completely backed up
+    def add_user(self, login):
+        self._write({'type': self._USER, 'login': login})
+
+    # that archive (path relative to the root dir) has been properly closed,
+    # and can be re-used as it is
+    def add_part(self, login, path):
+        self._write({'type': self._PART, 'login': login, 'path': path})
+
+    def close(self):
+        with self._lock:
+            self._stream.close()
+
+    # deletes the journal, once there's nothing left to resume
+    def delete(self):
+        self.close()
+        os.remove(self._path)
+
+    def _write(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._stream.write(line)
+            self._stream.flush()
+
+    # returns what had been done when that session stopped
+    @staticmethod
+    def load(root_dir, session_name):
+        state = JournalState()
+        with open(Journal._get_path(root_dir, session_name), 'r') as stream:
+            for line in stream:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    Log.debug(u'Ignoring truncated journal line: {}'
+                              .format(line))
+                    continue
+                login = record['login']
+                if record['type'] == Journal._DOCUMENT:
+                    state.documents.setdefault(login, dict())[
+                        record['doc_id']
+                    ] = record['entry']
+                elif record['type'] == Journal._USER:
+                    state.users.add(login)
+                elif record['type'] == Journal._PART:
+                    state.parts.add(record['path'])
+        return state
+
+
+class JournalState(object):
+
+    def __init__(self):
+        # maps logins to dicts mapping doc ids to their manifest entries
+        self.documents = dict()
+        # the logins of the users completely backed up
+        self.users = set()
+        # the paths of the archives properly closed
+        self.parts = set()
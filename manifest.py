@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import json
+import shutil
+
+from utils import *
+
+
+# the record of what was saved for one user during one session, mapping
+# each doc id to its metadata at the time, and to where its files are stored
+class Manifest(object):
+
+    def __init__(self, entries=None, largest_change_id=None):
+        self._entries = entries if entries is not None else dict()
+        # the id of the most recent change in the user's Drive when we
+        # started backing them up
+        self.largest_change_id = largest_change_id
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, doc_id):
+        return self._entries.get(doc_id)
+
+    # iterates over (doc id, entry) tuples
+    @property
+    def entries(self):
+        return self._entries.iteritems()
+
+    # files should be a list of dicts with at least a 'name' key (the name of
+    # the file) and a 'path' key (where it's stored, relative to the
+    # backend's root dir), and optionally a 'size' key (the size of the
+    # stored file)
+    def add(self, document, files):
+        self.add_entry(document.id, self.make_entry(document, files))
+
+    def add_entry(self, doc_id, entry):
+        self._entries[doc_id] = entry
+
+    @staticmethod
+    def make_entry(document, files):
+        return {
+            # enough to re-build the document without listing it again
+            'meta': document.used_meta,
+            'modifiedDate': document.get_meta('modifiedDate'),
+            'md5Checksum': document.get_meta('md5Checksum'),
+            'formats': document.formats,
+            'files': files
+        }
+
+    # returns true iff the given entry is still an accurate backup of
+    # the document
+    @staticmethod
+    def is_up_to_date(entry, document):
+        modified_date = document.get_meta('modifiedDate')
+        if not modified_date or entry['modifiedDate'] != modified_date:
+            return False
+        md5 = document.get_meta('md5Checksum')
+        if md5 and entry['md5Checksum'] != md5:
+            return False
+        size = document.get_meta('fileSize')
+        if size and entry['meta'].get('fileSize') != size:
+            return False
+        return entry['formats'] == document.formats
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as stream:
+            json.dump({'largest_change_id': self.largest_change_id,
+                       'entries': self._entries}, stream)
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'r') as stream:
+            data = json.load(stream)
+        return Manifest(data['entries'], data.get('largest_change_id'))
+
+
+# keeps the manifests of all the sessions in one dir per session (outside of
+# the sessions' dirs, so that they don't get mistaken for users' backups)
+# a user's manifest is only written once that user has been successfully
+# backed up, so the most recent one is always complete
+class ManifestStore(object):
+
+    _DIR_NAME = '.manifests'
+
+    def __init__(self, root_dir, session_name):
+        self._dir = os.path.join(root_dir, self._DIR_NAME)
+        self._session_name = session_name
+        # the previous sessions that have manifests, most recent first
+        # (lazily loaded)
+        self._previous_sessions = None
+
+    def save(self, login, manifest):
+        session_dir = os.path.join(self._dir, self._session_name)
+        try:
+            os.makedirs(session_dir)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        manifest.save(self._get_path(self._session_name, login))
+
+    # returns the user's manifest from the most recent previous session
+    # they were successfully backed up in, or None if there's none
+    def load_previous(self, login):
+        for session_name in self._get_previous_sessions():
+            path = self._get_path(session_name, login)
+            if not os.path.isfile(path):
+                continue
+            try:
+                Log.debug(u'Loading manifest {}'.format(path))
+                return Manifest.load(path)
+            except (IOError, ValueError, KeyError) as ex:
+                Log.error(u'Ignoring corrupted manifest {}: {}'
+                          .format(path, ex), with_BT=False)
+        return None
+
+    # deletes the user's manifest for that session, or all of the
+    # session's manifests if no login is given
+    def delete(self, session_name, login=None):
+        if login is None:
+            path = os.path.join(self._dir, session_name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            return
+        try:
+            os.remove(self._get_path(session_name, login))
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def _get_path(self, session_name, login):
+        return os.path.join(self._dir, session_name, u'{}.json'.format(login))
+
+    def _get_previous_sessions(self):
+        if self._previous_sessions is None:
+            try:
+                names = os.listdir(self._dir)
+            except OSError:
+                names = []
+            # session names sort chronologically
+            self._previous_sessions = sorted(
+                [name for name in names if name < self._session_name],
+                reverse=True
+            )
+        return self._previous_sessions
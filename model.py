@@ -8,6 +8,8 @@ import dateutil.parser
 import time
 import os
 import tempfile
+import threading
+from collections import deque, OrderedDict
 
 from oauth2client.client import AccessTokenRefreshError
 
@@ -15,6 +17,7 @@ import client as client_module
 from utils import *
 from apiclient.errors import HttpError
 from configuration import Configuration
+from pipeline import DocumentPipeline, DelayedRetryQueue
 
 
 class User(object):
@@ -27,7 +30,8 @@ class User(object):
         self._client = client
         self._documents = None
         self._folders = UserFolders(self) if need_folders else None
-        self._black_listed_ids = []
+        # maps doc ids to the number of 403 errors we got on them
+        self._nb_403_errors = dict()
 
     def __repr__(self):
         return self._login
@@ -58,77 +62,247 @@ class User(object):
         client.authorize(self)
         return client.drive_service
 
-    def save_documents(self, backend, owned_only):
+    # the id of the most recent change in that user's Drive
+    @property
+    @RetryPolicy('metadata')
+    def largest_change_id(self):
+        about = self.drive_service.about().get(
+            fields='largestChangeId'
+        ).execute()
+        return int(about['largestChangeId'])
+
+    # use_changes set to True will only list the documents that changed
+    # since the user's previous backup, if the backend knows about it
+    def save_documents(self, backend, owned_only, use_changes=False):
+        if not backend.start_user(self):
+            Log.verbose(u'{} has already been backed up, skipping'
+                        .format(self.login))
+            return
         Log.verbose(u'Processing docs for {}'.format(self.login))
-        doc_generator = self.document_generator
-        for document in doc_generator:
-            if not backend.need_to_fetch_contents(self, document) \
-                    or (owned_only and not document.is_owned):
-                # mark as done, and get to the next one
-                Log.verbose(
-                    u'Not necessary to fetch doc id {}'.format(document.id)
-                )
-                doc_generator.add_processed_id(document.id)
-                continue
+        doc_generator = self._get_document_generator(backend, use_changes)
+        nb_downloaders = Configuration.get('pipeline_download_threads',
+                                           is_int=True)
+        if nb_downloaders > 1:
+            self._save_documents_concurrently(doc_generator, backend,
+                                              owned_only, nb_downloaders)
+        else:
+            self._save_documents_sequentially(doc_generator, backend,
+                                              owned_only)
+        # let's save some memory
+        self._cleanup()
+        backend.close_user(self)
 
-            Log.verbose(u'Processing {}\'s doc "{}" (id: {})'.format(
-                self.login, document.title, document.id
-            ))
+    def _get_document_generator(self, backend, use_changes):
+        if use_changes:
+            # get it before listing anything, so that the changes happening
+            # while we're backing up that user will be seen next time
+            backend.set_largest_change_id(self, self.largest_change_id)
             try:
-                document.fetch_contents(self._client)
-                self._save_single_document(backend, document)
-            except client_module.ExpiredTokenException as ex:
-                if document.id in self._black_listed_ids:
-                    # we already got a 403 on that one!
-                    explanation = 'Two 403 errors on a row on document id {}'\
-                        .format(document.id)
-                    ex.brive_explanation = explanation
-                    raise
-                # otherwise try again
-                Log.verbose(
-                    '403 response, sleeping one minute and re-trying...'
-                )
-                time.sleep(60)
-                # the re-auth is handled by the the list request
-                doc_generator.reset_to_current_page()
-                self._black_listed_ids.append(document.id)
-                continue
+                documents = self._list_documents_from_changes(backend)
+                if documents is not None:
+                    return DocumentList(documents)
             except Exception as ex:
-                explanation = \
-                    'Unexpected error when processing ' \
-                    + '{}\'s documents '.format(self.login) \
-                    + u'(doc id: {})'.format(document.id)
-                ex.brive_explanation = explanation
+                Log.error(u'Could not list {}\'s changes, '.format(self.login)
+                          + u'falling back to listing all docs: {}'.format(ex),
+                          with_BT=False)
+        return self.document_generator
+
+    # returns the documents that changed since the user's previous backup
+    # (as listed by Google), plus the ones that didn't (as re-built from
+    # the previous backup's manifest), or None if there's no previous backup
+    def _list_documents_from_changes(self, backend):
+        manifest = backend.get_previous_manifest(self)
+        if manifest is None or manifest.largest_change_id is None:
+            Log.verbose(u'No previous change id for {}, listing all docs'
+                        .format(self.login))
+            return None
+        # maps file ids to their most recent change
+        changes = dict()
+        for change in client_module.UserChangesGenerator(
+                self, manifest.largest_change_id + 1):
+            changes[change['fileId']] = change
+        Log.verbose(u'{} file(s) changed since {}\'s previous backup'
+                    .format(len(changes), self.login))
+        result = []
+        for change in changes.values():
+            if change.get('deleted') or 'file' not in change:
+                continue
+            document = Document(change['file'], self.folders)
+            if not document.is_folder:
+                result.append(document)
+        for doc_id, entry in manifest.entries:
+            if doc_id not in changes:
+                result.append(Document(entry['meta'], self.folders))
+        return result
+
+    # documents getting a 403 are tried again later, in between the next
+    # ones (the listing's own token is handled by the generator)
+    def _save_documents_sequentially(self, doc_generator, backend,
+                                     owned_only):
+        retries = DelayedRetryQueue()
+        for document in doc_generator:
+            self._retry_documents(backend, retries)
+            if self._need_to_save(backend, document, owned_only):
+                self._fetch_and_save(backend, document, retries)
+        # the documents still waiting to be tried again
+        while len(retries):
+            time.sleep(retries.get_wait(60))
+            self._retry_documents(backend, retries)
+
+    def _retry_documents(self, backend, retries):
+        document = retries.pop_due()
+        while document is not None:
+            # our access token might be the culprit
+            self._client.authorize(self)
+            self._fetch_and_save(backend, document, retries)
+            document = retries.pop_due()
+
+    def _fetch_and_save(self, backend, document, retries):
+        Log.verbose(u'Processing {}\'s doc "{}" (id: {})'.format(
+            self.login, document.title, document.id
+        ))
+        nb_403_errors = self._nb_403_errors.get(document.id, 0)
+        try:
+            document.fetch_contents(self._client, nb_403_errors > 0)
+            self._save_single_document(backend, document)
+        except client_module.ExpiredTokenException as ex:
+            # don't leave the streams already opened hanging, they hold
+            # pooled connections
+            document.del_contents()
+            nb_403_errors += 1
+            self._nb_403_errors[document.id] = nb_403_errors
+            if not retries.push(document, nb_403_errors):
+                ex.brive_explanation = \
+                    u'{} 403 errors in a row on document id {}' \
+                    .format(nb_403_errors, document.id)
                 raise
-            # mark as done
-            doc_generator.add_processed_id(document.id)
-        # let's save some memory
-        self._cleanup()
-        backend.close_user(self)
+        except Exception as ex:
+            explanation = \
+                'Unexpected error when processing ' \
+                + '{}\'s documents '.format(self.login) \
+                + u'(doc id: {})'.format(document.id)
+            ex.brive_explanation = explanation
+            raise
 
-    def retrieve_single_document(self, backend, doc_id):
+    # the listing is done in the current thread, while the downloads happen
+    # in parallel in nb_downloaders threads
+    def _save_documents_concurrently(self, doc_generator, backend,
+                                     owned_only, nb_downloaders):
+        queue_depth = Configuration.get('pipeline_queue_depth', is_int=True)
+        pipeline = DocumentPipeline(
+            self, self._client,
+            lambda document: self._save_single_document(backend, document),
+            nb_downloaders, max(queue_depth, nb_downloaders),
+            backend.ordered_saves
+        )
+        pipeline.start()
         try:
-            document = self.retrieve_single_document_meta(doc_id)
-        except Exception as e:
-            explanation = 'Error while retrieving single document id ' \
-                + u'{} for user {}, '.format(doc_id, self.login) \
-                + 'it\'s liklely this user isn\'t allowed to see that doc'
-            e.brive_explanation = explanation
+            for document in doc_generator:
+                if self._need_to_save(backend, document, owned_only):
+                    pipeline.submit(document)
+        except BaseException:
+            # don't leave the pipeline's threads behind
+            pipeline.stop()
             raise
-        document.fetch_contents(self._client)
-        self._save_single_document(backend, document)
+        pipeline.join()
+
+    def _need_to_save(self, backend, document, owned_only):
+        if (owned_only and not document.is_owned) \
+                or not backend.need_to_fetch_contents(self, document):
+            Log.verbose(
+                u'Not necessary to fetch doc id {}'.format(document.id)
+            )
+            return False
+        return True
+
+    def retrieve_single_document(self, backend, doc_id):
+        self.retrieve_documents(backend, [doc_id])
+
+    # the meta data of all these documents are fetched at once first
+    def retrieve_documents(self, backend, doc_ids):
+        documents = self.retrieve_documents_meta(doc_ids)
+        for doc_id in doc_ids:
+            document = documents[doc_id]
+            if isinstance(document, Exception):
+                explanation = 'Error while retrieving single document id ' \
+                    + u'{} for user {}, '.format(doc_id, self.login) \
+                    + 'it\'s liklely this user isn\'t allowed to see that doc'
+                document.brive_explanation = explanation
+                raise document
+            document.fetch_contents(self._client)
+            self._save_single_document(backend, document)
 
-    # NOTE: Google's API doesn't like to get a lot of such calls,
-    # so use defensively...
-    @Utils.multiple_tries_decorator()
     def retrieve_single_document_meta(self, doc_id, is_folder=False):
+        result = self.retrieve_documents_meta([doc_id], is_folder)[doc_id]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    # Google's batch requests can't hold more than that many requests
+    _MAX_BATCH_SIZE = 100
+
+    # NOTE: Google's API doesn't like to get a lot of such calls, so they're
+    # grouped in batch requests
+    # returns a dict mapping each doc id to its Document (or Folder), or to
+    # the exception we got when trying to fetch it
+    def retrieve_documents_meta(self, doc_ids, is_folder=False):
+        klass = Folder if is_folder else Document
+        # no duplicates in a batch
+        doc_ids = list(OrderedDict.fromkeys(doc_ids))
+        result = dict()
+        for start in range(0, len(doc_ids), self._MAX_BATCH_SIZE):
+            batch_ids = doc_ids[start:start + self._MAX_BATCH_SIZE]
+            try:
+                self._retrieve_batch_meta(batch_ids, klass, result)
+            except Exception as ex:
+                for doc_id in batch_ids:
+                    result.setdefault(doc_id, ex)
+        return result
+
+    # fills result with the docs that aren't in it yet, raises an exception
+    # if some of them got throttled, so that they're tried again
+    @RetryPolicy('metadata')
+    def _retrieve_batch_meta(self, doc_ids, klass, result):
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id not in result]
+        if not doc_ids:
+            return
+        # maps the doc ids to the exception we got for them
+        throttled = dict()
+
+        def callback(doc_id, meta, exception):
+            if exception is None:
+                result[doc_id] = klass(meta, self.folders)
+            elif self._is_throttling(exception):
+                throttled[doc_id] = exception
+            else:
+                result[doc_id] = exception
+
+        Log.debug(u'Fetching the meta data of {} doc(s) for {}'
+                  .format(len(doc_ids), self.login))
         try:
-            meta = self.drive_service.files().get(fileId=doc_id).execute()
-            klass = Folder if is_folder else Document
-            return klass(meta, self.folders)
+            service = self.drive_service
+            batch = service.new_batch_http_request(callback=callback)
+            for doc_id in doc_ids:
+                batch.add(service.files().get(
+                    fileId=doc_id, fields=klass.get_fields_projection()
+                ), request_id=doc_id)
+            # Google counts each of those requests against our quotas
+            self._client.acquire_quota(len(doc_ids) - 1)
+            batch.execute()
         except AccessTokenRefreshError:
             # most likely 403
             raise client_module.ExpiredTokenException
+        if throttled:
+            Log.debug(u'{} request(s) throttled in batch'
+                      .format(len(throttled)))
+            raise throttled.values()[0]
+
+    @staticmethod
+    def _is_throttling(http_error):
+        status = http_error.resp.status
+        if status == 403:
+            return 'ratelimitexceeded' in (http_error.content or '').lower()
+        return status == 429 or status >= 500
 
     def _save_single_document(self, backend, document):
         try:
@@ -149,33 +323,41 @@ class User(object):
     def _cleanup(self):
         del self._documents
         del self._folders
-        del self._black_listed_ids
+        del self._nb_403_errors
 
 
 # keeps tracks of the user's folders, and caches the paths to them
+# paths can be resolved from several threads at once (e.g. the listing
+# thread carrying documents over, while the pipeline's writer saves others),
+# hence the lock
 class UserFolders(object):
 
     def __init__(self, user):
         self._user = user
         self._initialized = False
+        # re-entrant, since get_path is recursive
+        self._lock = threading.RLock()
 
     def get_path(self, folder_id):
         if folder_id is None:
             # the root has ID None by convention
             return ''
-        self._do_init()
-        folder = self._get_folder_from_id(folder_id)
-        parent_path = self.get_path(folder.parent_id)
+        with self._lock:
+            self._do_init()
+            folder = self._get_folder_from_id(folder_id)
+            parent_path = self.get_path(folder.parent_id)
         parent_path += os.sep if parent_path else ''
         return parent_path + folder.title
 
+    # must be called with the lock held
     def _do_init(self):
         if self._initialized:
             return
-        self._initialized = True
         Log.debug(u'Initializing folders for user {}'.format(self._user.login))
-        # dict that maps a folder id to its object
+        # dict that maps a folder id to its object (or to the exception we
+        # got when trying to fetch it)
         self._folders = self._build_folders()
+        self._initialized = True
 
     def _build_folders(self):
         folder_generator = client_module.UserDocumentsGenerator(
@@ -186,16 +368,35 @@ class UserFolders(object):
     # sometimes a folder could have been created during the current run,
     # in which case we don't have it in the cache
     def _get_folder_from_id(self, folder_id):
-        try:
-            return self._folders[folder_id]
-        except KeyError:
+        if folder_id not in self._folders:
             Log.debug(u'Could not find folder {} in cache, trying to fetch it'
                       .format(folder_id))
-            folder = self._user.retrieve_single_document_meta(folder_id, True)
-            self._folders[folder_id] = folder
-            return folder
-
-
+            self._fetch_folders([folder_id])
+        folder = self._folders[folder_id]
+        if isinstance(folder, Exception):
+            raise folder
+        return folder
+
+    # fetches those folders, then their parents we don't have yet, and so
+    # on, one level at a time (each level in as few requests as possible)
+    # must be called with the lock held
+    def _fetch_folders(self, folder_ids):
+        while folder_ids:
+            folders = self._user.retrieve_documents_meta(folder_ids, True)
+            self._folders.update(folders)
+            folder_ids = self._get_missing_parent_ids(folders.values())
+
+    def _get_missing_parent_ids(self, folders):
+        return list({
+            folder.parent_id for folder in folders
+            if not isinstance(folder, Exception)
+            and folder.parent_id is not None
+            and folder.parent_id not in self._folders
+        })
+
+
+# in streaming mode, the contents are a single-use stream: the request is
+# made once, and the body can then be read only once
 class DocumentContent(object):
 
     def __init__(self, client, url, document):
@@ -205,22 +406,34 @@ class DocumentContent(object):
         headers, self._content = self._make_request()
         self.file_name = self._get_file_name(headers)
         self.size = None
+        self._consumed = False
+        # the size we expect the stream to have, if we can trust it
+        self._expected_size = self._get_expected_size(headers)
 
     _CHUNK_SIZE = 1048576  # 1 Mb
 
+    # see Document.formats
+    @property
+    def format(self):
+        return Document.get_format_from_url(self._url)
+
     # returns a file-like object
     # if size_requested is set to True, then the self.size attribute
     # will be accurate after this returns
     def get_file_object(self, size_requested=False):
         if self._client.streaming:
-            _, self._content = self._make_request()
+            if size_requested and self._expected_size is not None:
+                self.size = self._expected_size
             if not size_requested or self.size is not None:
-                return self._content
-            # we need to copy the whole thing to the disk, and then return it
-            Log.debug(u'Copying to temp file {}'.format(self.file_name))
-            result = tempfile.TemporaryFile()
-            self.write_to_file(result, True)
-            self.size = os.fstat(result.fileno()).st_size
+                return self._consume_stream()
+            # we need to copy the whole thing (to memory if it's small
+            # enough, to the disk otherwise), and then return it
+            Log.debug(u'Spooling {} to a temp file'.format(self.file_name))
+            result = tempfile.SpooledTemporaryFile(
+                Configuration.get('backend_spool_threshold', is_int=True)
+            )
+            self.write_to_file(result)
+            self.size = result.tell()
             # let's rewind the file before returning it
             result.seek(0)
         else:
@@ -229,23 +442,50 @@ class DocumentContent(object):
                 self.size = result.len
         return result
 
-    def write_to_file(self, f, content_up_to_date=False):
+    def write_to_file(self, f):
         if self._client.streaming:
-            if not content_up_to_date:
-                _, self._content = self._make_request()
-            for blck in iter(lambda: self._content.read(self._CHUNK_SIZE), ''):
+            stream = self._consume_stream()
+            for blck in iter(lambda: stream.read(self._CHUNK_SIZE), ''):
                 f.write(blck)
         else:
             f.write(self._content)
         f.flush()
 
-    @Utils.multiple_tries_decorator(client_module.ExpiredTokenException)
+    # gives back the connection if the stream hasn't been read
+    def close(self):
+        if self._client.streaming and not self._consumed:
+            self._consumed = True
+            self._content.close()
+
+    def _consume_stream(self):
+        if self._consumed:
+            raise Exception(u'The contents of {} have already been read'
+                            .format(self.file_name))
+        self._consumed = True
+        return self._content
+
     def _make_request(self):
-        return self._client.request(
-            self._url, brive_expected_error_status=403,
-            brive_streaming=True
+        endpoint = 'download' if self.format == 'download' else 'export'
+        return RetryPolicy(endpoint, client_module.ExpiredTokenException).call(
+            self._client.request, self._url,
+            brive_expected_error_status=403, brive_streaming=True
         )
 
+    # Google's exports don't have a known size, but direct downloads do
+    # (as long as they're not encoded)
+    def _get_expected_size(self, headers):
+        if headers.get('content-encoding', 'identity') != 'identity':
+            return None
+        try:
+            return int(headers['content-length'])
+        except (KeyError, ValueError):
+            pass
+        if self.format == 'download':
+            size = self._document.get_meta('fileSize')
+            if size is not None:
+                return int(size)
+        return None
+
     _split_extension_regex = re.compile(r'\.([^.]+)$')
     _name_from_header_regex = re.compile(
         r'^attachment;\s*filename(?:="|\*=[A-Za-z0-9-]+\'\')([^"]+)(?:"|$)'
@@ -274,8 +514,33 @@ class DocumentContent(object):
         return result
 
 
+# iterates over documents that have already been listed, with the same
+# interface as client.UserDocumentsGenerator
+class DocumentList(object):
+
+    def __init__(self, documents):
+        self._documents = deque(documents)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self._documents.popleft()
+        except IndexError:
+            raise StopIteration
+
+
 class Document(object):
 
+    # the meta data fields Brive actually uses
+    USED_FIELDS = ('id', 'title', 'mimeType', 'modifiedDate', 'md5Checksum',
+                   'fileSize', 'parents', 'userPermission', 'downloadUrl',
+                   'exportLinks')
+
+    # the sub fields we use, for the fields above we don't use all of
+    _USED_SUB_FIELDS = {'parents': 'id,isRoot', 'userPermission': 'role'}
+
     _extension_from_url_regex = re.compile(r'exportFormat=([^&]+)$')
 
     _folder_mime_type = r'application/vnd.google-apps.folder'
@@ -331,6 +596,18 @@ class Document(object):
         except IndexError:
             return None
 
+    # the formats this document gets downloaded in: the extensions of the
+    # export formats, or 'download' for a direct download
+    @property
+    def formats(self):
+        return sorted([Document.get_format_from_url(url)
+                       for url in self._get_download_urls()])
+
+    @staticmethod
+    def get_format_from_url(url):
+        ext_matches = Document._extension_from_url_regex.findall(url)
+        return ext_matches[0] if ext_matches else 'download'
+
     @property
     def modified_timestamp(self):
         try:
@@ -381,6 +658,8 @@ class Document(object):
                 self._do_fetch_contents(client, True, banned_urls)
 
     def del_contents(self):
+        for document_content in self._contents or []:
+            document_content.close()
         del self._contents
         self._contents = None
 
@@ -389,6 +668,22 @@ class Document(object):
             return self._meta[key]
         return default
 
+    # returns the partial response projection to ask Google for, so that
+    # it only sends us the fields we use
+    @classmethod
+    def get_fields_projection(cls):
+        return ','.join(
+            u'{}({})'.format(field, cls._USED_SUB_FIELDS[field])
+            if field in cls._USED_SUB_FIELDS else field
+            for field in cls.USED_FIELDS
+        )
+
+    # the subset of the meta data that Brive uses
+    @property
+    def used_meta(self):
+        return {key: self._meta[key] for key in Document.USED_FIELDS
+                if key in self._meta}
+
     def _get_download_urls(self, ignore_preferred=False, banned_urls=list()):
         result = []
         if 'downloadUrl' in self._meta:
@@ -466,8 +761,10 @@ class Document(object):
 # (just parent_id and title)
 class Folder(Document):
 
+    USED_FIELDS = ('id', 'parents', 'title')
+
     def __init__(self, meta, user_folders):
         super(Folder, self).__init__(meta, user_folders)
-        new_meta = {key: meta[key] for key in ('id', 'parents', 'title')}
+        new_meta = {key: meta[key] for key in Folder.USED_FIELDS}
         del self._meta
         self._meta = new_meta
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import Queue
+import time
+import heapq
+
+import client as client_module
+from utils import *
+
+
+# a bounded producer/consumer pipeline to process one user's documents:
+# the listing thread submits documents, several downloader threads fetch
+# their contents in parallel, and a single writer thread saves them
+# at most queue_depth documents are in the pipeline at any given time,
+# which bounds memory usage
+class DocumentPipeline(object):
+
+    # how long (in seconds) blocked threads wait before checking whether
+    # another thread failed
+    _WAIT_TIMEOUT = 1
+
+    # sentinel telling threads there's nothing left to process
+    _DONE = None
+
+    # ordered set to True will make the writer save the documents in the
+    # same order as they were submitted
+    def __init__(self, user, client, save, nb_downloaders, queue_depth,
+                 ordered=False):
+        self._user = user
+        self._client = client
+        self._save = save
+        self._nb_downloaders = nb_downloaders
+        self._queue_depth = queue_depth
+        self._ordered = ordered
+        self._to_download = Queue.Queue()
+        # the items that got a 403, and wait to be downloaded again
+        self._retries = DelayedRetryQueue()
+        self._to_save = Queue.Queue()
+        self._condition = threading.Condition()
+        # number of documents submitted, but not saved yet
+        self._in_flight = 0
+        self._next_seq_nb = 0
+        self._error = None
+        # set when giving up on the documents left (see stop)
+        self._stopped = False
+        self._downloaders = []
+        self._writer = None
+
+    def start(self):
+        self._downloaders = [
+            self._start_thread(self._download_loop, 'downloader-{}'.format(i))
+            for i in range(self._nb_downloaders)
+        ]
+        self._writer = self._start_thread(self._write_loop, 'writer')
+
+    # blocks until there's room in the pipeline
+    def submit(self, document):
+        with self._condition:
+            while self._in_flight >= self._queue_depth and not self._error:
+                self._condition.wait(self._WAIT_TIMEOUT)
+            self._raise_if_failed()
+            self._in_flight += 1
+            item = _PipelineItem(self._next_seq_nb, document)
+            self._next_seq_nb += 1
+        self._to_download.put(item)
+
+    # waits for all the submitted documents to be saved
+    def join(self):
+        # the documents waiting to be tried again are still in flight, and
+        # need the downloaders
+        with self._condition:
+            while self._in_flight and not self._error:
+                self._condition.wait(self._WAIT_TIMEOUT)
+        self._shut_down()
+        self._raise_if_failed()
+
+    # gives up on the documents still in the pipeline, and waits for the
+    # threads to be done (e.g. when the listing failed)
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._shut_down()
+
+    def _shut_down(self):
+        for _ in self._downloaders:
+            self._to_download.put(self._DONE)
+        for downloader in self._downloaders:
+            self._wait_for(downloader)
+        self._to_save.put(self._DONE)
+        self._wait_for(self._writer)
+
+    def _start_thread(self, target, name):
+        thread = threading.Thread(
+            target=self._run_safely, args=(target,),
+            name=u'{}-{}'.format(self._user.login, name)
+        )
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _wait_for(self, thread):
+        while thread.is_alive():
+            thread.join(self._WAIT_TIMEOUT)
+
+    def _run_safely(self, target):
+        try:
+            target()
+        except BaseException as ex:
+            with self._condition:
+                if self._error is None:
+                    self._error = ex
+                self._condition.notify_all()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+    def _download_loop(self):
+        client = self._client.clone()
+        client.authorize(self._user)
+        while True:
+            item = self._retries.pop_due()
+            if item is not None:
+                # our access token might be the culprit
+                client.authorize(self._user)
+            else:
+                try:
+                    item = self._to_download.get(
+                        timeout=self._retries.get_wait(self._WAIT_TIMEOUT)
+                    )
+                except Queue.Empty:
+                    continue
+            if item is self._DONE or self._error or self._stopped:
+                return
+            if self._download(client, item):
+                self._to_save.put(item)
+
+    # returns false if the download is to be tried again later
+    def _download(self, client, item):
+        document = item.document
+        Log.verbose(u'Processing {}\'s doc "{}" (id: {})'.format(
+            self._user.login, document.title, document.id
+        ))
+        try:
+            try:
+                document.fetch_contents(client, item.nb_retries > 0)
+            except client_module.ExpiredTokenException as ex:
+                # don't leave the streams already opened hanging, they hold
+                # pooled connections
+                document.del_contents()
+                item.nb_retries += 1
+                if not self._retries.push(item, item.nb_retries):
+                    ex.brive_explanation = \
+                        u'{} 403 errors in a row on document id {}' \
+                        .format(item.nb_retries, document.id)
+                    raise
+                return False
+            return True
+        except Exception as ex:
+            if not hasattr(ex, 'brive_explanation'):
+                ex.brive_explanation = \
+                    'Unexpected error when processing ' \
+                    + '{}\'s documents '.format(self._user.login) \
+                    + u'(doc id: {})'.format(document.id)
+            raise
+
+    def _write_loop(self):
+        # maps sequence numbers to items downloaded too early
+        # (only used if ordered)
+        pending = dict()
+        next_seq_nb = 0
+        while not self._error:
+            item = self._to_save.get()
+            if item is self._DONE or self._stopped:
+                return
+            if not self._ordered:
+                self._write(item)
+                continue
+            pending[item.seq_nb] = item
+            while next_seq_nb in pending:
+                self._write(pending.pop(next_seq_nb))
+                next_seq_nb += 1
+
+    def _write(self, item):
+        self._save(item.document)
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+
+class _PipelineItem(object):
+
+    def __init__(self, seq_nb, document):
+        self.seq_nb = seq_nb
+        self.document = document
+        # how many times that document got a 403
+        self.nb_retries = 0
+
+
+# documents (or anything really) that got a 403, and that will be tried
+# again a bit later, while the other documents keep being processed:
+# Google sometimes denies access to one document for a while, for no
+# apparent reason
+class DelayedRetryQueue(object):
+
+    # how long (in seconds) to wait before the 1st retry, the 2nd one...
+    # there's no 3rd one
+    _DELAYS = (10, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (due time, push number, item) tuples, the push number keeps items
+        # due at the same time in order
+        self._heap = []
+        self._nb_pushed = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+    # nb_retries is the number of the retry to schedule (starting at 1)
+    # returns false if there are no more retries left for that item
+    def push(self, item, nb_retries):
+        if nb_retries > len(self._DELAYS):
+            return False
+        delay = self._DELAYS[nb_retries - 1]
+        Log.verbose(u'403 response, will try again in {}s'.format(delay))
+        with self._lock:
+            heapq.heappush(self._heap,
+                           (time.time() + delay, self._nb_pushed, item))
+            self._nb_pushed += 1
+        return True
+
+    # returns the next item due, or None if none is due yet
+    def pop_due(self):
+        with self._lock:
+            if self._heap and self._heap[0][0] <= time.time():
+                return heapq.heappop(self._heap)[2]
+        return None
+
+    # returns how long (in seconds) until the next item is due, at most
+    # max_wait
+    def get_wait(self, max_wait):
+        with self._lock:
+            if not self._heap:
+                return max_wait
+            return min(max(self._heap[0][0] - time.time(), 0), max_wait)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import Queue
+
+from utils import *
+from model import User
+
+
+# backs up several users at once
+# each worker thread gets its own client (and thus its own Http object and
+# authorization state), while the backend is shared between all of them
+class UserScheduler(object):
+
+    # how often (in seconds) the main thread wakes up while waiting for the
+    # workers (joining without a timeout would make it deaf to Ctrl-C)
+    _JOIN_TIMEOUT = 1
+
+    def __init__(self, client, backend, nb_workers, keep_dirs, owned_only,
+                 use_changes):
+        self._client = client
+        self._backend = backend
+        self._nb_workers = nb_workers
+        self._keep_dirs = keep_dirs
+        self._owned_only = owned_only
+        self._use_changes = use_changes
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        # maps the logins of the users we failed to back up
+        # to the exception that occurred
+        self._failures = dict()
+        # how many workers got a client, or could still get one
+        self._nb_clients_left = 0
+
+    # backs up all the given users, and returns a dict mapping the logins
+    # of the ones that failed to the corresponding exception
+    def run(self, users):
+        logins = Queue.Queue()
+        for user in users:
+            logins.put(user.login)
+        nb_workers = min(self._nb_workers, len(users))
+        self._nb_clients_left = nb_workers
+        Log.verbose(u'Starting {} workers for {} users'
+                    .format(nb_workers, len(users)))
+        workers = [
+            threading.Thread(target=self._work, args=(logins,),
+                             name='brive-worker-{}'.format(i))
+            for i in range(nb_workers)
+        ]
+        try:
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(self._JOIN_TIMEOUT)
+        except BaseException:
+            # don't let the workers start new users, the backend is
+            # most likely about to be cleaned up
+            self._stopping.set()
+            raise
+        return self._failures
+
+    def _work(self, logins):
+        try:
+            client = self._client.clone()
+        except Exception as ex:
+            Log.error(u'Could not create a new client: {}'.format(ex))
+            with self._lock:
+                self._nb_clients_left -= 1
+                if self._nb_clients_left:
+                    # let the other workers take care of the remaining users
+                    return
+                # nobody's left to back them up
+                if not hasattr(ex, 'brive_explanation'):
+                    ex.brive_explanation = u'Could not create a new client'
+                while True:
+                    try:
+                        self._failures[logins.get_nowait()] = ex
+                    except Queue.Empty:
+                        return
+        while not self._stopping.is_set():
+            try:
+                login = logins.get_nowait()
+            except Queue.Empty:
+                return
+            user = User(login, client, self._keep_dirs)
+            try:
+                user.save_documents(self._backend, self._owned_only,
+                                    self._use_changes)
+            except Exception as ex:
+                self._handle_failure(user, ex)
+
+    def _handle_failure(self, user, ex):
+        explanation = getattr(ex, 'brive_explanation', repr(ex))
+        Log.error(u'Failed to back up {}: {}'.format(user.login, explanation),
+                  with_BT=False)
+        with self._lock:
+            self._failures[user.login] = ex
+        try:
+            self._backend.discard_user(user)
+        except Exception as discard_ex:
+            Log.error(u'Could not discard {}\'s partial backup: {}'
+                      .format(user.login, discard_ex), with_BT=False)
@@ -8,6 +8,11 @@ google:
         p12_file: 'XXX.p12'
         # secret on the p12 file - it so happens that Google always uses that one
         p12_secret: 'notasecret'
+        # optional: a file to cache access tokens in between runs, which saves
+        # one request per user if you run Brive again within the hour
+        # (anyone reading that file can access your users' data for up to
+        # an hour, so keep it safe!)
+        # token_cache_file: 'tokens.json'
 
     # about your google apps domain
     domain:
@@ -16,11 +21,94 @@ google:
         # the login of one of the admins
         admin_login: 'XXX'
 
+    # optional: your app's quotas, as found on the same console (tab 'APIs &
+    # Auth > APIs > Drive API > Quotas'), in requests per 100 seconds: we
+    # pace our requests to stay within them, instead of waiting for Google
+    # to tell us we've gone over, so better set them a bit lower than the
+    # actual quotas ('0' means no limit), default to Drive's default quotas
+    quota:
+        per_user: '1000'
+        per_project: '10000'
+
 backend:
     # path to the folder you want to save your files in
     root_dir: 'save/'
     # optional: whether to compress the files or not (defaults to False)
     compression: 'False'
     # optional: compression format, is 'compression' is set to 'True'
-    # must be either gz or bz2, defaults to gz
+    # must be one of gz, bz2, xz (which requires the backports.lzma package
+    # on Python 2) or zstd (which requires the zstandard package) for tar
+    # archives, or zip to get zip archives instead, with an index that makes
+    # restoring a single document (with --restore) instant (the compression
+    # level and threads below don't apply to zip), defaults to gz
     compression_format: 'gz'
+    # optional: the compression level, from 1 (fastest) to 9 (smallest)
+    # for gz and bz2, 0 to 9 for xz and 1 to 22 for zstd, defaults to the
+    # format's own default (9 for gz and bz2, 6 for xz, 3 for zstd)
+    # compression_level: '6'
+    # optional: how many threads to compress with, if more than 1 the archive
+    # is compressed in independent blocks in parallel (like pigz, pbzip2 or
+    # xz -T do), which any gzip, bzip2 or xz tool can read (zstd has its own
+    # multi-threading), defaults to 1
+    compression_threads: '1'
+    # optional: if compression is set to True, whether to keep the files
+    # that are already compressed (pictures, videos, archives, office
+    # documents...) uncompressed in a separate <login>.stored.tar archive
+    # (or as uncompressed entries in zip archives), instead of wasting CPU on
+    # compressing them again, defaults to False
+    # note that this changes the layout of tar backups: each user then gets
+    # that second archive next to their usual one
+    skip_compressed: 'False'
+    # optional: if skip_compressed is set to True, the MIME types of the
+    # files kept uncompressed (a trailing slash matches all the types in
+    # that family), and their extensions (mostly for Google docs' exports):
+    # setting either replaces the whole default list (see constants.yml)
+    # stored_mime_types:
+    #     - 'image/jpeg'
+    #     - 'video/'
+    # stored_extensions:
+    #     - 'jpg'
+    #     - 'mp4'
+    # optional: when using compression with --streaming-http, documents whose
+    # size isn't known in advance (e.g. Google docs exports) are kept in
+    # memory up to that many bytes, and written to a temp file beyond that,
+    # defaults to 16 Mb
+    spool_threshold: '16777216'
+    # optional: whether to re-use the files saved during previous sessions
+    # for documents that haven't changed since, instead of downloading them
+    # again (can be disabled for one run with --full), defaults to True
+    incremental: 'True'
+    # optional: if incremental is set to True and compression to False,
+    # whether to hard link unchanged files from previous sessions instead of
+    # copying them, so that they only take up disk space once (every session
+    # still looks like a full backup), defaults to True
+    hardlink: 'True'
+    # optional: whether to store each version of a document only once, no
+    # matter how many users it's shared with nor how many sessions it
+    # appears in (each user's backup then hard links to it), defaults to
+    # False - can't be used together with compression
+    deduplicate: 'False'
+
+# optional: how many requests to Google can be in the air at once (all users
+# and download threads together): that limit starts at 8, grows as long as
+# Google copes, and is halved every time Google pushes back (with a rate
+# limiting 403, a 429 or a 5xx response), but always stays between the floor
+# and the ceiling, which default to 4 and 32
+# a request only counts until its response's headers arrive, so streamed
+# downloads can outnumber that limit while their contents are being read
+http:
+    concurrency_floor: '4'
+    concurrency_ceiling: '32'
+
+# optional: how documents are downloaded for each user
+pipeline:
+    # number of threads downloading a given user's documents in parallel
+    # (can also be set with --download-threads), defaults to 1
+    download_threads: '1'
+    # maximum number of documents being downloaded or waiting to be saved
+    # for a given user, defaults to 20
+    queue_depth: '20'
+    # how many pages of documents to list in advance, in the background,
+    # while the current one is being processed ('0' to disable), defaults
+    # to 2
+    listing_prefetch_depth: '2'
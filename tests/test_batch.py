@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+# client needs to be imported first, model and client import each other
+import client
+from googleapiclient.http import BatchHttpRequest, HttpMockSequence, \
+    HttpRequest
+from utils import Log
+
+_BATCH_URI = 'https://www.googleapis.com/batch'
+_BOUNDARY = 'batch_boundary'
+
+
+def _batch_response(status, content):
+    return (
+        {'status': '200',
+         'content-type': 'multipart/mixed; boundary={}'.format(_BOUNDARY)},
+        '--{0}\r\n'
+        'Content-Type: application/http\r\n'
+        'Content-ID: <response-doc+doc_id>\r\n'
+        '\r\n'
+        'HTTP/1.1 {1}\r\n'
+        'Content-Type: application/json\r\n'
+        '\r\n'
+        '{2}\r\n'
+        '--{0}--\r\n'.format(_BOUNDARY, status, content)
+    )
+
+
+class _FakePool(object):
+
+    def __init__(self, http):
+        self._http = http
+        self._http.connections = dict()
+
+    def acquire(self):
+        return self._http
+
+    def release(self, http, reusable=True):
+        pass
+
+    def record_request(self, http, uri):
+        pass
+
+
+class _FakeCredentials(object):
+
+    access_token_expired = False
+
+    def __init__(self):
+        self.token = 'expired'
+        self.nb_refreshes = 0
+
+    def apply(self, headers):
+        headers['authorization'] = 'Bearer ' + self.token
+
+    def refresh(self, http):
+        self.nb_refreshes += 1
+        self.token = 'fresh'
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        Log.init(False, False)
+        self._mock = HttpMockSequence([
+            _batch_response('401 Unauthorized', '{}'),
+            _batch_response('200 OK', '{"id": "doc_id"}')
+        ])
+        self._http = client.PooledHttp(
+            _FakePool(self._mock), client.RateLimiter(None, None),
+            client.ConcurrencyController(1, 1)
+        )
+        self._credentials = _FakeCredentials()
+        self._http.credentials = self._credentials
+        self._responses = dict()
+
+    def _callback(self, request_id, response, exception):
+        self._responses[request_id] = (response, exception)
+
+    def test_credentials_are_exposed_on_request(self):
+        self.assertIs(self._credentials, self._http.request.credentials)
+
+    def test_unauthorized_requests_are_retried(self):
+        batch = BatchHttpRequest(callback=self._callback,
+                                 batch_uri=_BATCH_URI)
+        request = HttpRequest(
+            self._http, lambda resp, content: content,
+            'https://www.googleapis.com/drive/v2/files/doc_id', headers={}
+        )
+        batch.add(request, request_id='doc_id')
+        batch.execute()
+        self.assertEqual(1, self._credentials.nb_refreshes)
+        self.assertEqual(('{"id": "doc_id"}', None),
+                         self._responses['doc_id'])
+        self.assertEqual([], self._mock._iterable)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir)
+sys.path.insert(0, ROOT_DIR)
+
+# client needs to be imported first, model and client import each other
+import client
+from backend import ZipBackend
+from configuration import Configuration
+from model import Document
+from utils import Log
+
+
+class _FakeUser(object):
+
+    login = 'user'
+
+
+class ZipBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        Log.init(False, False)
+        Configuration(os.path.join(ROOT_DIR, 'settings.yml.tpl'),
+                      os.path.join(ROOT_DIR, 'constants.yml'))
+        self._root_dir = tempfile.mkdtemp()
+        Configuration.set('backend_root_dir', self._root_dir)
+        self._backend = ZipBackend(False)
+        self._file = tempfile.NamedTemporaryFile()
+        self._file.write('contents')
+        self._file.flush()
+
+    def tearDown(self):
+        self._file.close()
+        shutil.rmtree(self._root_dir)
+
+    def _add_file(self, meta):
+        user = _FakeUser()
+        document = Document(dict(meta, id='doc_id', title='doc'), None)
+        self._backend._add_file(user, document, 'doc.txt', self._file.name)
+        zip_file, _ = self._backend._get_zipfile(user)
+        return zip_file.filelist[-1]
+
+    def test_document_without_modified_date(self):
+        zip_info = self._add_file({})
+        self.assertEqual((1980, 1, 1, 0, 0, 0), zip_info.date_time)
+
+    def test_document_before_1980(self):
+        zip_info = self._add_file({'modifiedDate': '1970-06-01T00:00:00'})
+        self.assertEqual((1980, 1, 1, 0, 0, 0), zip_info.date_time)
+
+    def test_document_with_modified_date(self):
+        zip_info = self._add_file({'modifiedDate': '2015-06-01T12:30:00'})
+        self.assertEqual((2015, 6, 1, 12, 30, 0), zip_info.date_time)
+
+
+if __name__ == '__main__':
+    unittest.main()
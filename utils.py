@@ -4,6 +4,13 @@ import time
 import sys
 import traceback
 import os
+import random
+import threading
+import functools
+import email.utils
+import socket
+import httplib
+import httplib2
 
 
 class SettingsFiles(object):
@@ -12,58 +19,260 @@ class SettingsFiles(object):
     CONSTANTS_FILE = base_dir + r'constants.yml'
 
 
-class Utils(object):
+# what to do when a call fails: retry it, with a delay growing at random
+# (decorrelated jitter, so that threads failing together don't retry in
+# lockstep) unless the server tells us how long to wait (Retry-After)
+# all the policies share a retry budget for the whole run, so that a
+# failing Google can't make us retry forever, and the calls to a given
+# endpoint class (e.g. 'list', 'download') go through a circuit breaker,
+# which pauses them all while that endpoint keeps failing
+# can be used as a decorator, or with call
+class RetryPolicy(object):
 
-    # if a try fails, we'll re-try it that many times at most
-    _MAX_NB_TRIES = 10
     # waiting time at the 1st failure (in seconds)
-    _INITIAL_BACKOFF = 1
-    # by how much to multiply the backoff waiting time at every try
-    _BACKOFF_FACTOR = 2
+    _BASE_DELAY = 1
+    # no retry waits longer than that (in seconds), unless told so by
+    # the server
+    _MAX_DELAY = 64
+    # how long (in seconds) a call can wait in total for its endpoint's
+    # circuit to close, before giving up
+    _MAX_CIRCUIT_WAIT = 900
 
-    @staticmethod
-    def multiple_tries_decorator(blacklist=None,
-                                 max_nb_tries=_MAX_NB_TRIES,
-                                 initial_backoff=_INITIAL_BACKOFF,
-                                 backoff_factor=_BACKOFF_FACTOR):
+    # blacklist is a list of exception types (or a single one) that should
+    # not be retried
+    def __init__(self, endpoint, blacklist=None, max_nb_tries=10,
+                 base_delay=_BASE_DELAY, max_delay=_MAX_DELAY):
         if blacklist is None:
             blacklist = []
         elif type(blacklist) is not list:
             blacklist = [blacklist]
+        self._endpoint = endpoint
+        self._blacklist = tuple(blacklist)
+        self._max_nb_tries = max_nb_tries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._breaker = CircuitBreaker.get(endpoint)
 
-        def internal_decorator(function):
-            def result(*args, **kwargs):
-                return Utils._multiple_tries_rec(
-                    function, blacklist, 1, args, kwargs,
-                    max_nb_tries, initial_backoff, backoff_factor
-                )
-            return result
-        return internal_decorator
+    def __call__(self, function):
+        @functools.wraps(function)
+        def result(*args, **kwargs):
+            return self.call(function, *args, **kwargs)
+        return result
 
-    @staticmethod
-    def _multiple_tries_rec(
-            function, blacklist, try_nb, args, kwargs,
-            max_nb_tries, current_backoff, backoff_factor):
-        try:
-            return function(*args, **kwargs)
-        except Exception as ex:
-            if type(ex) in blacklist:
+    def call(self, function, *args, **kwargs):
+        _RETRY_BUDGET.record_call()
+        delay = self._base_delay
+        try_nb = 1
+        circuit_wait = 0
+        while True:
+            try:
+                self._breaker.before_call()
+                try:
+                    result = function(*args, **kwargs)
+                except self._blacklist:
+                    # the endpoint did answer, it's up to the caller
+                    self._breaker.on_success()
+                    raise
+                except Exception as ex:
+                    # errors about one document (a 404, a 403...) don't
+                    # mean the endpoint is failing
+                    if self._is_endpoint_failure(ex):
+                        self._breaker.on_failure()
+                    else:
+                        self._breaker.on_success()
+                    raise
+                self._breaker.on_success()
+                return result
+            except self._blacklist as ex:
                 Log.debug(
                     u'Caught a blacklisted {}, re-throwing'.format(type(ex))
                 )
                 raise
-            if try_nb >= max_nb_tries:
-                Log.debug('Too many tries, re-throwing')
-                raise
-            Log.debug(u'Attempt # {} calling '.format(try_nb) +
-                      u'{} with '.format(function.__name__) +
-                      u'args {} and kwargs {} '.format(args, kwargs) +
-                      u'failed with: {}, sleeping '.format(ex) +
-                      u'{}s then re-trying...'.format(current_backoff))
-            time.sleep(current_backoff)
-            return Utils._multiple_tries_rec(
-                function, blacklist, try_nb + 1, args, kwargs,
-                max_nb_tries, current_backoff * backoff_factor, backoff_factor)
+            except CircuitOpenException as ex:
+                # we didn't even call Google, so that's not a try
+                if circuit_wait >= self._MAX_CIRCUIT_WAIT:
+                    Log.debug('Waited too long for the circuit to close, '
+                              're-throwing')
+                    ex.brive_explanation = \
+                        u'Google\'s {} requests kept failing'.format(
+                            self._endpoint
+                        )
+                    raise
+                sleep = min(ex.retry_in,
+                            self._MAX_CIRCUIT_WAIT - circuit_wait)
+                Log.debug(u'{}, sleeping {:.1f}s then re-trying...'
+                          .format(ex, sleep))
+                time.sleep(sleep)
+                circuit_wait += sleep
+            except Exception as ex:
+                if try_nb >= self._max_nb_tries:
+                    Log.debug('Too many tries, re-throwing')
+                    raise
+                if not _RETRY_BUDGET.withdraw():
+                    Log.debug('Retry budget exhausted, re-throwing')
+                    raise
+                delay = self._get_next_delay(delay)
+                sleep = max(delay, self._get_retry_after(ex) or 0)
+                Log.debug(u'Attempt # {} calling '.format(try_nb) +
+                          u'{} with '.format(function.__name__) +
+                          u'args {} and kwargs {} '.format(args, kwargs) +
+                          u'failed with: {}, sleeping '.format(ex) +
+                          u'{:.1f}s then re-trying...'.format(sleep))
+                time.sleep(sleep)
+                try_nb += 1
+
+    # returns true iff that exception means the endpoint itself is failing:
+    # a transport error, or a 429 or 5xx response
+    @staticmethod
+    def _is_endpoint_failure(ex):
+        if isinstance(ex, (socket.error, httplib.HTTPException,
+                           httplib2.HttpLib2Error)):
+            return True
+        status = getattr(ex, 'brive_status', None)
+        if status is None:
+            response = getattr(ex, 'resp', None)
+            status = getattr(response, 'status', None)
+        if status is None:
+            return False
+        status = int(status)
+        return status == 429 or status >= 500
+
+    # decorrelated jitter, see
+    # https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    def _get_next_delay(self, previous_delay):
+        return min(self._max_delay,
+                   random.uniform(self._base_delay, previous_delay * 3))
+
+    # returns the delay advised by the server (in seconds), if any
+    # that can come from our own exceptions (see Client.request), or from
+    # the HttpErrors raised by Google's client
+    @staticmethod
+    def _get_retry_after(ex):
+        value = getattr(ex, 'brive_retry_after', None)
+        if value is None:
+            response = getattr(ex, 'resp', None)
+            if response is not None and hasattr(response, 'get'):
+                value = response.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        # can also be an HTTP date
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(email.utils.mktime_tz(date) - time.time(), 0)
+
+
+# allows up to that many retries plus a ratio of the number of calls made
+# so far, for the whole run
+class _RetryBudget(object):
+
+    _MIN_RETRIES = 50
+    _RATIO = 0.2
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._nb_calls = 0
+        self._nb_retries = 0
+
+    def record_call(self):
+        with self._lock:
+            self._nb_calls += 1
+
+    # returns false iff the budget is exhausted
+    def withdraw(self):
+        with self._lock:
+            if self._nb_retries >= \
+                    self._MIN_RETRIES + self._RATIO * self._nb_calls:
+                return False
+            self._nb_retries += 1
+            return True
+
+
+_RETRY_BUDGET = _RetryBudget()
+
+
+class CircuitOpenException(Exception):
+
+    def __init__(self, endpoint, retry_in):
+        super(CircuitOpenException, self).__init__(
+            u'Circuit open for {} requests'.format(endpoint)
+        )
+        # how long (in seconds) until calls are let through again
+        self.retry_in = retry_in
+
+
+# one per endpoint class, shared by all threads: after too many failures
+# in a row, the circuit opens and calls fail right away (without calling
+# Google) until it's time to let one call through to see whether the
+# endpoint is back; if it is the circuit closes again, otherwise it stays
+# open for twice as long
+class CircuitBreaker(object):
+
+    # how many failures in a row open the circuit
+    _THRESHOLD = 5
+    # how long (in seconds) the circuit stays open at first, and at most
+    _INITIAL_COOLDOWN = 30
+    _MAX_COOLDOWN = 300
+
+    _registry_lock = threading.Lock()
+    # maps endpoint classes to their breakers
+    _breakers = dict()
+
+    @classmethod
+    def get(cls, endpoint):
+        with cls._registry_lock:
+            if endpoint not in cls._breakers:
+                cls._breakers[endpoint] = CircuitBreaker(endpoint)
+            return cls._breakers[endpoint]
+
+    def __init__(self, endpoint):
+        self._endpoint = endpoint
+        self._lock = threading.Lock()
+        self._nb_failures = 0
+        self._cooldown = self._INITIAL_COOLDOWN
+        # None when the circuit is closed
+        self._opened_until = None
+        # whether a call has been let through to test the endpoint
+        self._probing = False
+
+    # raises a CircuitOpenException if the call shouldn't be made
+    def before_call(self):
+        with self._lock:
+            if self._opened_until is None:
+                return
+            now = time.time()
+            if self._probing or now < self._opened_until:
+                raise CircuitOpenException(
+                    self._endpoint, max(self._opened_until - now, 1)
+                )
+            self._probing = True
+
+    def on_success(self):
+        with self._lock:
+            if self._opened_until is not None:
+                Log.verbose(u'{} requests are working again'
+                            .format(self._endpoint))
+            self._nb_failures = 0
+            self._cooldown = self._INITIAL_COOLDOWN
+            self._opened_until = None
+            self._probing = False
+
+    def on_failure(self):
+        with self._lock:
+            self._nb_failures += 1
+            if self._probing:
+                self._cooldown = min(self._cooldown * 2, self._MAX_COOLDOWN)
+            elif self._opened_until is not None \
+                    or self._nb_failures < self._THRESHOLD:
+                return
+            self._probing = False
+            self._opened_until = time.time() + self._cooldown
+            Log.verbose(u'{} requests keep failing, pausing them for {}s'
+                        .format(self._endpoint, self._cooldown))
 
 
 class Log(object):
@@ -106,3 +315,5 @@ class Log(object):
 
         Log.debug = pprint('DEBUG') if debug else void
         Log.verbose = pprint('INFO') if verbose or debug else void
+        # lets callers skip computing what they'd only log
+        Log.is_verbose = verbose or debug